@@ -1,6 +1,7 @@
 """Application implementation - ASGI."""
 
 import os
+import threading
 
 from fastapi import FastAPI, Request
 from fastapi.exceptions import RequestValidationError
@@ -80,3 +81,8 @@ def shutdown_event():
 @app.on_event("startup")
 def startup_event():
     logger.info("startup event")
+    if config.whisper.get("preload", False):
+        # load in the background so the server starts accepting requests right away
+        from app.services import subtitle
+
+        threading.Thread(target=subtitle.preload, daemon=True).start()
@@ -2,6 +2,7 @@ import glob
 import os
 import pathlib
 import shutil
+import uuid
 from typing import Union
 
 from fastapi import BackgroundTasks, Depends, Path, Request, UploadFile
@@ -80,6 +81,10 @@ def create_task(
     task_id = utils.get_uuid()
     request_id = base.get_task_id(request)
     try:
+        resume_task_id = getattr(body, "resume_task_id", None)
+        if resume_task_id:
+            # the task id becomes a directory name, only accept the ids we generate
+            task_id = str(uuid.UUID(resume_task_id))
         task = {
             "task_id": task_id,
             "request_id": request_id,
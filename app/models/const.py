@@ -10,11 +10,9 @@ PUNCTUATIONS = [
     "？",
     "，",
     "。",
-    "、",
     "；",
     "：",
     "！",
-    "...",
 ]
 
 TASK_STATE_FAILED = -1
@@ -106,6 +106,8 @@ class VideoParams(BaseModel):
     upload_to_youtube: Optional[bool] = True
     use_transitional_hook: bool = True
     specific_hook: Optional[str] = None
+    # Id of a previous task, its completed stages are reused instead of generated again
+    resume_task_id: Optional[str] = None
 
 
 class SubtitleRequest(BaseModel):
@@ -0,0 +1,86 @@
+"""
+Per-stage checkpoints of a task.
+
+Each stage of task.start (script, terms, audio, subtitle, materials, combined videos)
+records its outputs in <task dir>/checkpoints.json under a key derived from the
+stage inputs. A task restarted with the same task id skips every stage whose key
+still matches and whose output files are unchanged, instead of calling the LLM,
+TTS and stock APIs again.
+"""
+
+import json
+import os
+import threading
+from typing import List, Optional
+
+from loguru import logger
+
+from app.utils import utils
+
+_lock = threading.Lock()
+
+
+def checkpoint_file(task_id: str) -> str:
+    return os.path.join(utils.task_dir(task_id), "checkpoints.json")
+
+
+def key(*parts) -> str:
+    """
+    Content address of a stage, from its json-serializable inputs.
+    """
+    return utils.md5(json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str))
+
+
+def file_signature(file: str) -> list:
+    if not file or not os.path.isfile(file):
+        return [file, 0, 0]
+    stat = os.stat(file)
+    return [os.path.abspath(file), stat.st_size, stat.st_mtime]
+
+
+def _load_all(task_id: str) -> dict:
+    file = checkpoint_file(task_id)
+    if not os.path.isfile(file):
+        return {}
+    try:
+        with open(file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"failed to load checkpoints: {file} => {str(e)}")
+        return {}
+
+
+def load(task_id: str, stage: str, stage_key: str) -> Optional[dict]:
+    """
+    The saved outputs of a stage, or None if the stage has to run again.
+    """
+    with _lock:
+        entry = _load_all(task_id).get(stage)
+    if not entry or entry.get("key") != stage_key:
+        return None
+    for signature in entry.get("files", []):
+        if file_signature(signature[0]) != signature:
+            logger.info(f"checkpoint of stage '{stage}' is stale: {signature[0]} changed")
+            return None
+    logger.info(f"resuming from checkpoint, skip stage: {stage}")
+    return entry["data"]
+
+
+def save(
+    task_id: str, stage: str, stage_key: str, data: dict, files: List[str] = None
+):
+    with _lock:
+        checkpoints = _load_all(task_id)
+        checkpoints[stage] = {
+            "key": stage_key,
+            "data": data,
+            "files": [file_signature(f) for f in files or []],
+        }
+        file = checkpoint_file(task_id)
+        temp_file = f"{file}.tmp"
+        try:
+            with open(temp_file, "w", encoding="utf-8") as f:
+                json.dump(checkpoints, f, ensure_ascii=False, indent=2)
+            os.replace(temp_file, file)
+        except Exception as e:
+            logger.warning(f"failed to save checkpoint of stage '{stage}': {str(e)}")
@@ -0,0 +1,153 @@
+"""
+Second-tier cache of normalized clips.
+
+Downloaded materials are cached by url in storage/cache_videos, but each task still
+trims, resizes/letterboxes and resamples them to 30 fps. The results are cached here,
+keyed by (source hash, resolution, scale mode, clip window, fps), so a popular stock
+clip is transcoded once per aspect instead of once per task. The cache is bounded by
+total size and evicts the least recently used files first.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from typing import Callable
+
+from loguru import logger
+
+from app.config import config
+from app.utils import utils
+
+_source_hashes = {}
+_lock = threading.Lock()
+
+# materials downloaded by material.save_video are already named by the md5 of their url
+_material_name_pattern = re.compile(r"^vid-([0-9a-f]{32})\.mp4$")
+
+
+def cache_dir() -> str:
+    return utils.storage_dir("cache_normalized", create=True)
+
+
+def max_size() -> int:
+    return int(config.app.get("normalized_cache_max_mb", 2048)) * 1024 * 1024
+
+
+def enabled() -> bool:
+    return max_size() > 0
+
+
+def source_hash(source: str) -> str:
+    match = _material_name_pattern.match(os.path.basename(source))
+    if match:
+        return match.group(1)
+
+    stat = os.stat(source)
+    memo_key = (os.path.abspath(source), stat.st_size, stat.st_mtime)
+    with _lock:
+        if memo_key in _source_hashes:
+            return _source_hashes[memo_key]
+
+    md5 = hashlib.md5()
+    with open(source, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    digest = md5.hexdigest()
+    with _lock:
+        _source_hashes[memo_key] = digest
+    return digest
+
+
+def cache_file(
+    source: str,
+    start: float,
+    end: float,
+    width: int,
+    height: int,
+    fps: int,
+    scale_mode: str,
+) -> str:
+    key = utils.md5(
+        f"{source_hash(source)}|{width}x{height}|{scale_mode}|{start:.3f}-{end:.3f}|{fps}"
+    )
+    return os.path.join(cache_dir(), f"clip-{key}.mp4")
+
+
+def lookup(
+    source: str,
+    start: float,
+    end: float,
+    width: int,
+    height: int,
+    fps: int,
+    scale_mode: str,
+) -> str:
+    if not enabled():
+        return ""
+    file = cache_file(source, start, end, width, height, fps, scale_mode)
+    if os.path.isfile(file) and os.path.getsize(file) > 0:
+        # mtime is the lru clock
+        os.utime(file)
+        return file
+    return ""
+
+
+def get_or_create(
+    source: str,
+    start: float,
+    end: float,
+    width: int,
+    height: int,
+    fps: int,
+    scale_mode: str,
+    create: Callable[[str], None],
+) -> str:
+    """
+    Return the cached normalized clip, calling create(output_file) to encode it on a miss.
+    """
+    file = lookup(source, start, end, width, height, fps, scale_mode)
+    if file:
+        logger.debug(f"normalized clip cache hit: {file}")
+        return file
+
+    file = cache_file(source, start, end, width, height, fps, scale_mode)
+    # workers may normalize the same clip concurrently, publish atomically
+    temp_file = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp.mp4"
+    try:
+        create(temp_file)
+        os.replace(temp_file, file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    logger.debug(f"normalized clip cached: {file}")
+    evict()
+    return file
+
+
+def evict():
+    limit = max_size()
+    files = []
+    total = 0
+    for entry in os.scandir(cache_dir()):
+        if not entry.is_file() or not entry.name.startswith("clip-") or entry.name.endswith(".tmp.mp4"):
+            continue
+        stat = entry.stat()
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    if total <= limit:
+        return
+
+    files.sort()
+    for _, size, path in files:
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            logger.info(f"evicted normalized clip: {path}")
+        except FileNotFoundError:
+            total -= size
+        except Exception as e:
+            logger.warning(f"failed to evict normalized clip: {path} => {str(e)}")
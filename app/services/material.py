@@ -1,34 +1,134 @@
 import os
 import random
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from typing import Callable, List, Tuple
 from urllib.parse import urlencode
 
 import requests
+from requests.adapters import HTTPAdapter
 from loguru import logger
-from moviepy.video.io.VideoFileClip import VideoFileClip
 
 from app.config import config
 from app.models.schema import MaterialInfo, VideoAspect, VideoConcatMode
+from app.services import material_index, probe
 from app.utils import utils
 
-requested_count = 0
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# one pooled session for all searches and downloads, so connections are reused
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32)
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
+
+
+class ApiKeyPool:
+    """
+    Hands out the api keys of one provider, tracking the remaining quota and reset
+    time reported by the X-Ratelimit-* headers. Exhausted keys are skipped until
+    their reset time, the others are used least recently used first.
+    """
+
+    def __init__(self, cfg_key: str):
+        self.cfg_key = cfg_key
+        self._lock = threading.Lock()
+        # api key => [remaining requests or None if unknown, reset time, last used]
+        self._states = {}
+
+    def keys(self) -> List[str]:
+        api_keys = config.app.get(self.cfg_key)
+        if not api_keys:
+            raise ValueError(
+                f"\n\n##### {self.cfg_key} is not set #####\n\nPlease set it in the config.toml file: {config.config_file}\n\n"
+                f"{utils.to_json(config.app)}"
+            )
+        if isinstance(api_keys, str):
+            return [api_keys]
+        return list(api_keys)
+
+    def acquire(self) -> str:
+        api_keys = self.keys()
+        now = time.time()
+        with self._lock:
+            available = []
+            for api_key in api_keys:
+                state = self._states.setdefault(api_key, [None, 0.0, 0.0])
+                if state[1] and state[1] <= now:
+                    # quota window has reset
+                    state[0], state[1] = None, 0.0
+                if state[0] is None or state[0] > 0:
+                    available.append(api_key)
+
+            if available:
+                api_key = min(available, key=lambda k: self._states[k][2])
+            else:
+                api_key = min(api_keys, key=lambda k: self._states[k][1])
+                logger.warning(
+                    f"all {self.cfg_key} are rate limited, the next one resets in {self._states[api_key][1] - now:.0f} seconds"
+                )
+            state = self._states[api_key]
+            state[2] = now
+            if state[0]:
+                # reserve a request until the response reports the real quota
+                state[0] -= 1
+            return api_key
+
+    def update(self, api_key: str, response: requests.Response):
+        remaining = response.headers.get("X-Ratelimit-Remaining")
+        reset = response.headers.get("X-Ratelimit-Reset")
+        now = time.time()
+        with self._lock:
+            state = self._states.setdefault(api_key, [None, 0.0, now])
+            if remaining is not None and remaining.isdigit():
+                state[0] = int(remaining)
+            if reset is not None and reset.isdigit():
+                # pexels reports a unix timestamp, pixabay the seconds until the reset
+                reset = int(reset)
+                state[1] = reset if reset > 1_000_000_000 else now + reset
+            if response.status_code == 429:
+                state[0] = 0
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    state[1] = now + int(retry_after)
+                elif not state[1] or state[1] <= now:
+                    state[1] = now + 60
+
+
+_key_pools = {}
+_key_pools_lock = threading.Lock()
+
+
+def get_api_key_pool(cfg_key: str) -> ApiKeyPool:
+    with _key_pools_lock:
+        if cfg_key not in _key_pools:
+            _key_pools[cfg_key] = ApiKeyPool(cfg_key)
+        return _key_pools[cfg_key]
 
 
 def get_api_key(cfg_key: str):
-    api_keys = config.app.get(cfg_key)
-    if not api_keys:
-        raise ValueError(
-            f"\n\n##### {cfg_key} is not set #####\n\nPlease set it in the config.toml file: {config.config_file}\n\n"
-            f"{utils.to_json(config.app)}"
+    return get_api_key_pool(cfg_key).acquire()
+
+
+def _request_with_key(
+    cfg_key: str, send: Callable[[str], requests.Response]
+) -> requests.Response:
+    """
+    Send a request with a key from the pool, retrying with another key on HTTP 429.
+    """
+    pool = get_api_key_pool(cfg_key)
+    attempts = len(pool.keys())
+    for attempt in range(attempts):
+        api_key = pool.acquire()
+        r = send(api_key)
+        pool.update(api_key, r)
+        if r.status_code != 429:
+            return r
+        logger.warning(
+            f"api key {api_key[:6]}*** of {cfg_key} is rate limited, attempt {attempt + 1}/{attempts}"
         )
-
-    # if only one key is provided, return it
-    if isinstance(api_keys, str):
-        return api_keys
-
-    global requested_count
-    requested_count += 1
-    return api_keys[requested_count % len(api_keys)]
+    return r
 
 
 def search_videos_pexels(
@@ -36,27 +136,39 @@ def search_videos_pexels(
     minimum_duration: int,
     video_aspect: VideoAspect = VideoAspect.portrait,
 ) -> List[MaterialInfo]:
+    cached_items = material_index.get_search(
+        "pexels", search_term, video_aspect, minimum_duration
+    )
+    if cached_items is not None:
+        logger.info(f"found {len(cached_items)} cached pexels results for '{search_term}'")
+        return cached_items
+
     aspect = VideoAspect(video_aspect)
     video_orientation = aspect.name
     video_width, video_height = aspect.to_resolution()
-    api_key = get_api_key("pexels_api_keys")
-    headers = {
-        "Authorization": api_key,
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
-    }
     # Build URL
     params = {"query": search_term, "per_page": 20, "orientation": video_orientation}
     query_url = f"https://api.pexels.com/videos/search?{urlencode(params)}"
     logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
 
-    try:
-        r = requests.get(
+    def send(api_key: str) -> requests.Response:
+        headers = {
+            "Authorization": api_key,
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
+        }
+        return session.get(
             query_url,
             headers=headers,
             proxies=config.proxy,
             verify=False,
             timeout=(30, 60),
         )
+
+    # a missing key is a configuration error, not an empty search result
+    get_api_key_pool("pexels_api_keys").keys()
+
+    try:
+        r = _request_with_key("pexels_api_keys", send)
         response = r.json()
         video_items = []
         if "videos" not in response:
@@ -81,6 +193,9 @@ def search_videos_pexels(
                     item.duration = duration
                     video_items.append(item)
                     break
+        material_index.put_search(
+            "pexels", search_term, video_aspect, minimum_duration, video_items
+        )
         return video_items
     except Exception as e:
         logger.error(f"search videos failed: {str(e)}")
@@ -93,25 +208,36 @@ def search_videos_pixabay(
     minimum_duration: int,
     video_aspect: VideoAspect = VideoAspect.portrait,
 ) -> List[MaterialInfo]:
+    cached_items = material_index.get_search(
+        "pixabay", search_term, video_aspect, minimum_duration
+    )
+    if cached_items is not None:
+        logger.info(f"found {len(cached_items)} cached pixabay results for '{search_term}'")
+        return cached_items
+
     aspect = VideoAspect(video_aspect)
 
     video_width, video_height = aspect.to_resolution()
 
-    api_key = get_api_key("pixabay_api_keys")
-    # Build URL
-    params = {
-        "q": search_term,
-        "video_type": "all",  # Accepted values: "all", "film", "animation"
-        "per_page": 50,
-        "key": api_key,
-    }
-    query_url = f"https://pixabay.com/api/videos/?{urlencode(params)}"
-    logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
-
-    try:
-        r = requests.get(
+    def send(api_key: str) -> requests.Response:
+        # Build URL
+        params = {
+            "q": search_term,
+            "video_type": "all",  # Accepted values: "all", "film", "animation"
+            "per_page": 50,
+            "key": api_key,
+        }
+        query_url = f"https://pixabay.com/api/videos/?{urlencode(params)}"
+        logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
+        return session.get(
             query_url, proxies=config.proxy, verify=False, timeout=(30, 60)
         )
+
+    # a missing key is a configuration error, not an empty search result
+    get_api_key_pool("pixabay_api_keys").keys()
+
+    try:
+        r = _request_with_key("pixabay_api_keys", send)
         response = r.json()
         video_items = []
         if "hits" not in response:
@@ -137,6 +263,9 @@ def search_videos_pixabay(
                     item.duration = duration
                     video_items.append(item)
                     break
+        material_index.put_search(
+            "pixabay", search_term, video_aspect, minimum_duration, video_items
+        )
         return video_items
     except Exception as e:
         logger.error(f"search videos failed: {str(e)}")
@@ -144,7 +273,15 @@ def search_videos_pixabay(
     return []
 
 
-def save_video(video_url: str, save_dir: str = "") -> str:
+_search_functions = {
+    "pexels": search_videos_pexels,
+    "pixabay": search_videos_pixabay,
+}
+
+
+def save_video(
+    video_url: str, save_dir: str = "", cancel_event: threading.Event = None
+) -> str:
     if not save_dir:
         save_dir = utils.storage_dir("cache_videos")
 
@@ -165,26 +302,37 @@ def save_video(video_url: str, save_dir: str = "") -> str:
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
     }
 
-    # if video does not exist, download it
-    with open(video_path, "wb") as f:
-        f.write(
-            requests.get(
-                video_url,
-                headers=headers,
-                proxies=config.proxy,
-                verify=False,
-                timeout=(60, 240),
-            ).content
-        )
+    # if video does not exist, stream it to a partial file, so an interrupted
+    # download never shows up as a cached video
+    part_path = f"{video_path}.{threading.get_ident()}.part"
+    logger.info(f"downloading video: {video_url}")
+    try:
+        with session.get(
+            video_url,
+            headers=headers,
+            proxies=config.proxy,
+            verify=False,
+            timeout=(60, 240),
+            stream=True,
+        ) as r:
+            r.raise_for_status()
+            with open(part_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if cancel_event and cancel_event.is_set():
+                        logger.info(f"download cancelled: {video_url}")
+                        return ""
+                    f.write(chunk)
+        os.replace(part_path, video_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
 
     if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
         try:
-            clip = VideoFileClip(video_path)
-            duration = clip.duration
-            fps = clip.fps
-            clip.close()
-            if duration > 0 and fps > 0:
+            info = probe.probe(video_path)
+            if info["duration"] > 0 and info["fps"] > 0:
                 return video_path
+            raise ValueError(f"duration: {info['duration']}, fps: {info['fps']}")
         except Exception as e:
             try:
                 os.remove(video_path)
@@ -194,6 +342,74 @@ def save_video(video_url: str, save_dir: str = "") -> str:
     return ""
 
 
+def _search_providers(source: str) -> List[str]:
+    """
+    The requested provider, plus every other provider with api keys configured
+    when material_search_all_providers is enabled.
+    """
+    providers = [source]
+    if config.app.get("material_search_all_providers", False):
+        for provider in _search_functions:
+            if provider != source and config.app.get(f"{provider}_api_keys"):
+                providers.append(provider)
+    return providers
+
+
+def search_videos(
+    search_terms: List[str],
+    providers: List[str],
+    minimum_duration: int,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+) -> List[Tuple[str, List[MaterialInfo]]]:
+    """
+    Search every term on every provider concurrently.
+    Returns (search_term, video_items) pairs in term order, so the sequential concat
+    mode keeps the script order. Searches still running at the deadline are dropped.
+    """
+    jobs = [
+        (search_term, provider)
+        for search_term in search_terms
+        for provider in providers
+        if provider in _search_functions
+    ]
+    if not jobs:
+        return []
+    # raise configuration errors here instead of logging them as failed searches
+    for provider in {provider for _, provider in jobs}:
+        get_api_key_pool(f"{provider}_api_keys").keys()
+
+    timeout = config.app.get("material_search_timeout", 60)
+    executor = ThreadPoolExecutor(max_workers=min(len(jobs), 8))
+    futures = [
+        executor.submit(
+            _search_functions[provider],
+            search_term=search_term,
+            minimum_duration=minimum_duration,
+            video_aspect=video_aspect,
+        )
+        for search_term, provider in jobs
+    ]
+    _, not_done = wait(futures, timeout=timeout)
+    # don't block on searches that missed the deadline
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    results = []
+    for (search_term, provider), future in zip(jobs, futures):
+        if future in not_done:
+            logger.warning(
+                f"searching '{search_term}' on {provider} timed out after {timeout} seconds"
+            )
+            continue
+        try:
+            video_items = future.result()
+        except Exception as e:
+            logger.error(f"search videos failed: {str(e)}")
+            continue
+        logger.info(f"found {len(video_items)} videos for '{search_term}' on {provider}")
+        results.append((search_term, video_items))
+    return results
+
+
 def download_videos(
     task_id: str,
     search_terms: List[str],
@@ -202,50 +418,107 @@ def download_videos(
     video_contact_mode: VideoConcatMode = VideoConcatMode.random,
     audio_duration: float = 0.0,
     max_clip_duration: int = 5,
+    cancel_event: threading.Event = None,
 ) -> List[str]:
     valid_video_items = []
-    valid_video_urls = []
+    valid_video_urls = set()
+    video_terms = {}
+    local_video_paths = {}
     found_duration = 0.0
-    search_videos = search_videos_pexels
-    if source == "pixabay":
-        search_videos = search_videos_pixabay
+    providers = _search_providers(source)
 
-    for search_term in search_terms:
-        video_items = search_videos(
-            search_term=search_term,
-            minimum_duration=max_clip_duration,
-            video_aspect=video_aspect,
+    material_directory = config.app.get("material_directory", "").strip()
+    # clips downloaded into a task folder are deleted with the task, don't index them
+    index_enabled = material_directory != "task"
+    if material_directory == "task":
+        material_directory = utils.task_dir(task_id)
+    elif material_directory and not os.path.isdir(material_directory):
+        material_directory = ""
+
+    # 1. local inventory from previous tasks
+    local_duration = 0.0
+    if index_enabled:
+        for search_term in search_terms:
+            for provider in providers:
+                for item, video_path in material_index.find(
+                    search_term=search_term,
+                    video_aspect=video_aspect,
+                    provider=provider,
+                    minimum_duration=max_clip_duration,
+                ):
+                    if item.url not in valid_video_urls:
+                        valid_video_items.append(item)
+                        valid_video_urls.add(item.url)
+                        local_video_paths[item.url] = video_path
+                        found_duration += item.duration
+                        local_duration += min(max_clip_duration, item.duration)
+        logger.info(
+            f"found {len(local_video_paths)} videos in local inventory, duration: {local_duration} seconds"
         )
-        logger.info(f"found {len(video_items)} videos for '{search_term}'")
 
-        for item in video_items:
-            if item.url not in valid_video_urls:
-                valid_video_items.append(item)
-                valid_video_urls.append(item.url)
-                found_duration += item.duration
+    # 2. remote search, unless the local inventory already covers the audio
+    if local_duration <= audio_duration:
+        for search_term, video_items in search_videos(
+            search_terms, providers, max_clip_duration, video_aspect
+        ):
+            for item in video_items:
+                if item.url not in valid_video_urls:
+                    valid_video_items.append(item)
+                    valid_video_urls.add(item.url)
+                    video_terms[item.url] = search_term
+                    found_duration += item.duration
+    else:
+        logger.info("local inventory covers the required duration, skip searching")
 
     logger.info(
         f"found total videos: {len(valid_video_items)}, required duration: {audio_duration} seconds, found duration: {found_duration} seconds"
     )
     video_paths = []
 
-    material_directory = config.app.get("material_directory", "").strip()
-    if material_directory == "task":
-        material_directory = utils.task_dir(task_id)
-    elif material_directory and not os.path.isdir(material_directory):
-        material_directory = ""
-
     if video_contact_mode.value == VideoConcatMode.random.value:
         random.shuffle(valid_video_items)
 
-    total_duration = 0.0
-    for item in valid_video_items:
-        try:
-            logger.info(f"downloading video: {item.url}")
-            saved_video_path = save_video(
-                video_url=item.url, save_dir=material_directory
+    def _fetch(item: MaterialInfo) -> str:
+        local_video_path = local_video_paths.get(item.url)
+        if local_video_path:
+            return local_video_path
+        saved_video_path = save_video(
+            video_url=item.url,
+            save_dir=material_directory,
+            cancel_event=cancel_event,
+        )
+        if saved_video_path and index_enabled:
+            material_index.record(
+                saved_video_path, item, video_terms[item.url], video_aspect
             )
-            if saved_video_path:
+        return saved_video_path
+
+    total_duration = 0.0
+    # in-flight downloads stop at the next chunk once the duration budget is met,
+    # or when the caller cancels
+    if cancel_event is None:
+        cancel_event = threading.Event()
+    concurrency = config.app.get("material_download_concurrency", 4)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [executor.submit(_fetch, item) for item in valid_video_items]
+
+        # downloads finish in any order, results are taken in search order so the
+        # sequential concat mode keeps the order of the search terms
+        next_index = 0
+        covered = False
+        for _ in as_completed(futures):
+            while not covered and next_index < len(futures) and futures[next_index].done():
+                item = valid_video_items[next_index]
+                future = futures[next_index]
+                next_index += 1
+                try:
+                    saved_video_path = future.result()
+                except Exception as e:
+                    logger.error(f"failed to download video: {utils.to_json(item)} => {str(e)}")
+                    continue
+                if not saved_video_path:
+                    continue
+
                 logger.info(f"video saved: {saved_video_path}")
                 video_paths.append(saved_video_path)
                 seconds = min(max_clip_duration, item.duration)
@@ -254,9 +527,17 @@ def download_videos(
                     logger.info(
                         f"total duration of downloaded videos: {total_duration} seconds, skip downloading more"
                     )
-                    break
-        except Exception as e:
-            logger.error(f"failed to download video: {utils.to_json(item)} => {str(e)}")
+                    covered = True
+            if covered:
+                cancel_event.set()
+                for pending in futures:
+                    pending.cancel()
+                break
+
+    if index_enabled:
+        material_index.touch(
+            [p for url, p in local_video_paths.items() if p in video_paths]
+        )
     logger.success(f"downloaded {len(video_paths)} videos")
     return video_paths
 
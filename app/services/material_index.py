@@ -0,0 +1,263 @@
+"""
+On-disk index of downloaded materials.
+
+The download cache only holds vid-<md5>.mp4 files. This index records where each
+clip came from (provider, url, search terms), its resolution, duration and
+orientation, and when it was last used, so a search term can be satisfied from
+local inventory before calling the Pexels/Pixabay APIs.
+
+It also keeps a TTL cache of parsed search results, keyed by provider, term, aspect
+and minimum duration, so repeated searches don't spend the rate-limited API keys.
+"""
+
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+from typing import List, Optional, Tuple
+
+from loguru import logger
+
+from app.config import config
+from app.models.schema import MaterialInfo, VideoAspect
+from app.services import probe
+from app.utils import utils
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS clips (
+    path TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    orientation TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS clip_terms (
+    search_term TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (search_term, path)
+);
+CREATE INDEX IF NOT EXISTS idx_clips_url ON clips (url);
+CREATE TABLE IF NOT EXISTS searches (
+    key TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_searches_created_at ON searches (created_at);
+"""
+
+_initialized = set()
+
+
+def db_file() -> str:
+    return os.path.join(utils.storage_dir(create=True), "material_index.db")
+
+
+def _connect() -> sqlite3.Connection:
+    file = db_file()
+    conn = sqlite3.connect(file, timeout=30)
+    if file not in _initialized:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        _initialized.add(file)
+    return conn
+
+
+def _normalize_term(search_term: str) -> str:
+    return " ".join(search_term.lower().split())
+
+
+def record(
+    video_path: str,
+    item: MaterialInfo,
+    search_term: str,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+):
+    """
+    Add a downloaded clip to the index, or attach another search term to it.
+    """
+    path = os.path.abspath(video_path)
+    info = probe.probe(path)
+    now = time.time()
+    try:
+        with closing(_connect()) as conn, conn:
+            conn.execute(
+                """
+                INSERT INTO clips (path, url, provider, width, height, duration, orientation, created_at, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET last_used = excluded.last_used
+                """,
+                (
+                    path,
+                    item.url,
+                    item.provider,
+                    info["width"],
+                    info["height"],
+                    info["duration"],
+                    VideoAspect(video_aspect).name,
+                    now,
+                    now,
+                ),
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO clip_terms (search_term, path) VALUES (?, ?)",
+                (_normalize_term(search_term), path),
+            )
+    except Exception as e:
+        logger.warning(f"failed to index material: {path} => {str(e)}")
+
+
+def find(
+    search_term: str,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    provider: str = "pexels",
+    minimum_duration: int = 0,
+) -> List[Tuple[MaterialInfo, str]]:
+    """
+    Indexed clips previously downloaded for this search term, as (material, path) pairs.
+    Entries whose file has been deleted are dropped from the index.
+    """
+    try:
+        with closing(_connect()) as conn, conn:
+            rows = conn.execute(
+                """
+                SELECT c.path, c.url, c.provider, c.duration
+                FROM clips c JOIN clip_terms t ON t.path = c.path
+                WHERE t.search_term = ? AND c.orientation = ? AND c.provider = ? AND c.duration >= ?
+                ORDER BY c.last_used DESC
+                """,
+                (
+                    _normalize_term(search_term),
+                    VideoAspect(video_aspect).name,
+                    provider,
+                    minimum_duration,
+                ),
+            ).fetchall()
+
+            results = []
+            missing = []
+            for path, url, clip_provider, duration in rows:
+                if not os.path.isfile(path):
+                    missing.append((path,))
+                    continue
+                item = MaterialInfo()
+                item.provider = clip_provider
+                item.url = url
+                item.duration = duration
+                results.append((item, path))
+
+            if missing:
+                conn.executemany("DELETE FROM clips WHERE path = ?", missing)
+                conn.executemany("DELETE FROM clip_terms WHERE path = ?", missing)
+            return results
+    except Exception as e:
+        logger.warning(f"failed to query material index: {str(e)}")
+        return []
+
+
+def touch(video_paths: List[str]):
+    now = time.time()
+    try:
+        with closing(_connect()) as conn, conn:
+            conn.executemany(
+                "UPDATE clips SET last_used = ? WHERE path = ?",
+                [(now, os.path.abspath(p)) for p in video_paths],
+            )
+    except Exception as e:
+        logger.warning(f"failed to update material index: {str(e)}")
+
+
+def _search_key(
+    provider: str, search_term: str, video_aspect: VideoAspect, minimum_duration: int
+) -> str:
+    return "|".join(
+        [
+            provider,
+            _normalize_term(search_term),
+            VideoAspect(video_aspect).name,
+            str(minimum_duration),
+        ]
+    )
+
+
+def _search_ttl() -> float:
+    return float(config.app.get("search_cache_ttl_hours", 24)) * 3600
+
+
+def get_search(
+    provider: str,
+    search_term: str,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    minimum_duration: int = 0,
+) -> Optional[List[MaterialInfo]]:
+    """
+    Cached search results, or None on a miss or when the entry has expired.
+    """
+    ttl = _search_ttl()
+    if ttl <= 0:
+        return None
+    key = _search_key(provider, search_term, video_aspect, minimum_duration)
+    try:
+        with closing(_connect()) as conn:
+            row = conn.execute(
+                "SELECT payload FROM searches WHERE key = ? AND created_at >= ?",
+                (key, time.time() - ttl),
+            ).fetchone()
+    except Exception as e:
+        logger.warning(f"failed to query search cache: {str(e)}")
+        return None
+    if not row:
+        return None
+
+    video_items = []
+    for data in json.loads(row[0]):
+        item = MaterialInfo()
+        item.provider = data["provider"]
+        item.url = data["url"]
+        item.duration = data["duration"]
+        video_items.append(item)
+    return video_items
+
+
+def put_search(
+    provider: str,
+    search_term: str,
+    video_aspect: VideoAspect,
+    minimum_duration: int,
+    video_items: List[MaterialInfo],
+):
+    if _search_ttl() <= 0:
+        return
+    key = _search_key(provider, search_term, video_aspect, minimum_duration)
+    payload = json.dumps(
+        [
+            {"provider": i.provider, "url": i.url, "duration": i.duration}
+            for i in video_items
+        ]
+    )
+    max_entries = int(config.app.get("search_cache_max_entries", 1000))
+    now = time.time()
+    try:
+        with closing(_connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO searches (key, payload, created_at) VALUES (?, ?, ?)",
+                (key, payload, now),
+            )
+            conn.execute(
+                "DELETE FROM searches WHERE created_at < ?", (now - _search_ttl(),)
+            )
+            # keep the newest entries
+            conn.execute(
+                """
+                DELETE FROM searches WHERE key IN (
+                    SELECT key FROM searches ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (max(1, max_entries),),
+            )
+    except Exception as e:
+        logger.warning(f"failed to update search cache: {str(e)}")
@@ -0,0 +1,370 @@
+"""
+Cheap media metadata.
+
+Opening a VideoFileClip just to read duration, fps or size spawns an ffmpeg reader
+and costs hundreds of milliseconds. MP4/MOV files are probed by parsing the moov atom
+directly and MP3 files by scanning their frame headers (or reading the Xing/VBRI
+header); anything else falls back to a single `ffmpeg -i` call. Results are kept in
+a sqlite index keyed by path, mtime and size, so each file is probed once, also
+across worker processes.
+"""
+
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+from contextlib import closing
+from typing import Optional
+
+from loguru import logger
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+from app.config import config
+from app.utils import utils
+
+_CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"edts"}
+_MP4_EXTENSIONS = {"mp4", "mov", "m4v", "m4a", "3gp"}
+
+# kbps by [mpeg1][layer], index 0 is "free", 15 is invalid
+_MP3_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# Hz by version bits (0: mpeg 2.5, 2: mpeg 2, 3: mpeg 1)
+_MP3_SAMPLE_RATES = {
+    0: [11025, 12000, 8000],
+    2: [22050, 24000, 16000],
+    3: [44100, 48000, 32000],
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS probes (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    info TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_probes_created_at ON probes (created_at);
+"""
+# prune the index every this many new entries
+_PRUNE_INTERVAL = 100
+
+_initialized = set()
+_inserts = 0
+_lock = threading.Lock()
+
+
+def index_file() -> str:
+    return os.path.join(utils.storage_dir(create=True), "probe_index.db")
+
+
+def _connect() -> sqlite3.Connection:
+    file = index_file()
+    conn = sqlite3.connect(file, timeout=30)
+    if file not in _initialized:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        _initialized.add(file)
+    return conn
+
+
+def _lookup(path: str, stat: os.stat_result) -> Optional[dict]:
+    try:
+        with closing(_connect()) as conn:
+            row = conn.execute(
+                "SELECT info FROM probes WHERE path = ? AND mtime = ? AND size = ?",
+                (path, stat.st_mtime, stat.st_size),
+            ).fetchone()
+    except Exception as e:
+        logger.warning(f"failed to query probe index: {str(e)}")
+        return None
+    return json.loads(row[0]) if row else None
+
+
+def _store(path: str, stat: os.stat_result, info: dict):
+    """
+    Upsert one entry. Concurrent processes each write only their own rows, and
+    the oldest entries beyond probe_index_max_entries are pruned now and then.
+    """
+    global _inserts
+    with _lock:
+        _inserts += 1
+        prune = _inserts % _PRUNE_INTERVAL == 1
+    max_entries = int(config.app.get("probe_index_max_entries", 10000))
+    try:
+        with closing(_connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO probes (path, mtime, size, info, created_at) VALUES (?, ?, ?, ?, ?)",
+                (path, stat.st_mtime, stat.st_size, json.dumps(info), time.time()),
+            )
+            if prune:
+                conn.execute(
+                    """
+                    DELETE FROM probes WHERE path IN (
+                        SELECT path FROM probes ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (max(1, max_entries),),
+                )
+    except Exception as e:
+        logger.warning(f"failed to update probe index: {str(e)}")
+
+
+def _iter_boxes(data: bytes, offset: int = 0, end: int = None):
+    end = len(data) if end is None else end
+    while offset + 8 <= end:
+        size, box_type = struct.unpack(">I4s", data[offset : offset + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[offset + 8 : offset + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+def _read_moov(video_path: str) -> bytes:
+    with open(video_path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            header = f.read(16)
+            size, box_type = struct.unpack(">I4s", header[:8])
+            header_size = 8
+            if size == 1:
+                size = struct.unpack(">Q", header[8:16])[0]
+                header_size = 16
+            elif size == 0:
+                size = file_size - offset
+            if size < header_size:
+                break
+            if box_type == b"moov":
+                f.seek(offset + header_size)
+                return f.read(size - header_size)
+            # skip mdat and anything else without reading it
+            offset += size
+    return b""
+
+
+def _parse_track(data: bytes, start: int, end: int) -> dict:
+    track = {}
+    for box_type, box_start, box_end in _iter_boxes(data, start, end):
+        version = data[box_start] if box_end > box_start else 0
+        if box_type == b"tkhd":
+            # skip version/flags, times, track id, reserved, duration, reserved, layer, group, volume, reserved
+            pos = box_start + 4 + (32 if version == 1 else 20) + 16
+            matrix = struct.unpack(">9i", data[pos : pos + 36])
+            width, height = struct.unpack(">II", data[pos + 36 : pos + 44])
+            track["width"] = width >> 16
+            track["height"] = height >> 16
+            # a 90/270 degree rotation matrix swaps the displayed width and height
+            track["rotated"] = matrix[0] == 0 and matrix[1] != 0
+        elif box_type == b"mdhd":
+            pos = box_start + 4
+            if version == 1:
+                timescale, duration = struct.unpack(">IQ", data[pos + 16 : pos + 28])
+            else:
+                timescale, duration = struct.unpack(">II", data[pos + 8 : pos + 16])
+            track["timescale"] = timescale
+            track["duration"] = duration
+        elif box_type == b"hdlr":
+            track["handler"] = data[box_start + 8 : box_start + 12]
+        elif box_type == b"stts":
+            count = struct.unpack(">I", data[box_start + 4 : box_start + 8])[0]
+            samples = 0
+            ticks = 0
+            for i in range(count):
+                pos = box_start + 8 + i * 8
+                sample_count, sample_delta = struct.unpack(">II", data[pos : pos + 8])
+                samples += sample_count
+                ticks += sample_count * sample_delta
+            track["samples"] = samples
+            track["ticks"] = ticks
+        elif box_type in _CONTAINER_BOXES:
+            track.update(_parse_track(data, box_start, box_end))
+    return track
+
+
+def _probe_mp4(video_path: str) -> dict:
+    moov = _read_moov(video_path)
+    if not moov:
+        return {}
+
+    info = {"duration": 0.0, "fps": 0.0, "width": 0, "height": 0, "has_audio": False}
+    for box_type, box_start, box_end in _iter_boxes(moov):
+        if box_type == b"mvhd":
+            version = moov[box_start]
+            pos = box_start + 4
+            if version == 1:
+                timescale, duration = struct.unpack(">IQ", moov[pos + 16 : pos + 28])
+            else:
+                timescale, duration = struct.unpack(">II", moov[pos + 8 : pos + 16])
+            if timescale:
+                info["duration"] = duration / timescale
+        elif box_type == b"trak":
+            track = _parse_track(moov, box_start, box_end)
+            handler = track.get("handler")
+            if handler == b"soun":
+                info["has_audio"] = True
+            elif handler == b"vide" and not info["width"]:
+                width, height = track.get("width", 0), track.get("height", 0)
+                if track.get("rotated"):
+                    width, height = height, width
+                info["width"], info["height"] = width, height
+                timescale = track.get("timescale", 0)
+                if track.get("ticks") and timescale:
+                    info["fps"] = track["samples"] * timescale / track["ticks"]
+                if timescale and not info["duration"]:
+                    info["duration"] = track.get("duration", 0) / timescale
+    if not info["width"]:
+        return {}
+    return info
+
+
+def _mp3_frame(data: bytes, pos: int):
+    """
+    Parse the frame header at pos, returns (frame length, samples, sample rate,
+    side info length) or None if there is no valid header.
+    """
+    if pos + 4 > len(data) or data[pos] != 0xFF or data[pos + 1] & 0xE0 != 0xE0:
+        return None
+    version = (data[pos + 1] >> 3) & 0x03
+    layer = 4 - ((data[pos + 1] >> 1) & 0x03)
+    bitrate_index = data[pos + 2] >> 4
+    sample_rate_index = (data[pos + 2] >> 2) & 0x03
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = _MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (data[pos + 2] >> 1) & 0x01
+    mono = data[pos + 3] >> 6 == 3
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if mpeg1 or layer == 2 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+    if mpeg1:
+        side_info = 17 if mono else 32
+    else:
+        side_info = 9 if mono else 17
+    return length, samples, sample_rate, side_info
+
+
+def mp3_duration(data: bytes) -> float:
+    """
+    Duration (seconds) of MP3 data. VBR files with a Xing/Info or VBRI header are
+    measured from its frame count, otherwise every frame header is scanned, which
+    is exact for CBR files and for concatenated streams such as edge-tts chunks.
+    """
+    pos = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = 0
+        for b in data[6:10]:
+            size = (size << 7) | (b & 0x7F)
+        pos = 10 + size + (10 if data[5] & 0x10 else 0)
+
+    frame = None
+    while pos + 4 <= len(data):
+        frame = _mp3_frame(data, pos)
+        if frame:
+            break
+        pos += 1
+    if not frame:
+        return 0.0
+
+    length, samples, sample_rate, side_info = frame
+    xing = pos + 4 + side_info
+    if data[xing : xing + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack(">I", data[xing + 4 : xing + 8])[0]
+        stream_bytes = 0
+        if flags & 0x02:
+            stream_bytes = struct.unpack(">I", data[xing + 12 : xing + 16])[0]
+        # a header covering only part of the data belongs to the first of several concatenated files
+        if flags & 0x01 and (not stream_bytes or stream_bytes >= (len(data) - pos) * 0.9):
+            frames = struct.unpack(">I", data[xing + 8 : xing + 12])[0]
+            return frames * samples / sample_rate
+    vbri = pos + 4 + 32
+    if data[vbri : vbri + 4] == b"VBRI":
+        frames = struct.unpack(">I", data[vbri + 14 : vbri + 18])[0]
+        return frames * samples / sample_rate
+
+    duration = 0.0
+    while frame:
+        length, samples, sample_rate, _ = frame
+        if length <= 0:
+            break
+        duration += samples / sample_rate
+        pos += length
+        frame = _mp3_frame(data, pos)
+        # skip junk between frames, stop at trailing tags
+        while not frame and pos + 4 <= len(data) and data[pos : pos + 3] != b"TAG":
+            pos += 1
+            frame = _mp3_frame(data, pos)
+    return duration
+
+
+def _probe_mp3(audio_path: str) -> dict:
+    with open(audio_path, "rb") as f:
+        duration = mp3_duration(f.read())
+    if not duration:
+        return {}
+    return {"duration": duration, "fps": 0.0, "width": 0, "height": 0, "has_audio": True}
+
+
+def _probe_ffmpeg(file: str) -> dict:
+    infos = ffmpeg_parse_infos(file)
+    width, height = infos.get("video_size") or (0, 0)
+    return {
+        "duration": infos.get("video_duration") or infos.get("duration") or 0.0,
+        "fps": infos.get("video_fps") or 0.0,
+        "width": width,
+        "height": height,
+        "has_audio": bool(infos.get("audio_found")),
+    }
+
+
+def probe(file: str) -> dict:
+    """
+    Returns duration (seconds), fps, width, height and has_audio of a media file.
+    Raises if the file can not be probed.
+    """
+    path = os.path.abspath(file)
+    stat = os.stat(path)
+    info = _lookup(path, stat)
+    if info:
+        return info
+
+    info = {}
+    extension = utils.parse_extension(path)
+    if extension in _MP4_EXTENSIONS:
+        try:
+            info = _probe_mp4(path)
+        except Exception as e:
+            logger.debug(f"failed to parse mp4 atoms: {path} => {str(e)}")
+    elif extension == "mp3":
+        try:
+            info = _probe_mp3(path)
+        except Exception as e:
+            logger.debug(f"failed to parse mp3 frames: {path} => {str(e)}")
+    if not info:
+        info = _probe_ffmpeg(path)
+
+    _store(path, stat, info)
+    return dict(info)
+
+
+def duration(file: str) -> float:
+    return probe(file)["duration"]
@@ -0,0 +1,309 @@
+"""
+Single-pass ffmpeg render backend.
+
+The moviepy backend encodes the timeline three times (combined-N.mp4, final video,
+hook prefix). This backend compiles the whole timeline - clip trims, scale/pad,
+transitions, subtitle overlays, voice/bgm mix and the hook prefix - into one ffmpeg
+filtergraph and encodes once.
+"""
+
+import glob
+import os
+import subprocess
+from typing import List
+
+import numpy as np
+from loguru import logger
+from moviepy.config import FFMPEG_BINARY
+from PIL import Image
+
+from app.models.schema import (
+    VideoAspect,
+    VideoConcatMode,
+    VideoParams,
+    VideoTransitionMode,
+)
+from app.services import probe, subtitle_ass, timeline, video
+
+FPS = 30
+TRANSITION_DURATION = 1
+BGM_FADE_OUT_DURATION = 3
+HOOK_MAX_DURATION = 10
+AUDIO_FORMAT = "aformat=sample_fmts=fltp:sample_rates=44100:channel_layouts=stereo"
+
+
+def _fmt(value: float) -> str:
+    return f"{value:.3f}"
+
+
+def _normalize_filter(
+    width: int, height: int, duration: float, scale_mode: str = timeline.SCALE_FIT
+) -> str:
+    if scale_mode == timeline.SCALE_FILL:
+        scale = (
+            f"scale={width}:{height}:force_original_aspect_ratio=increase,"
+            f"crop={width}:{height}"
+        )
+    else:
+        scale = (
+            f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:color=black"
+        )
+    return (
+        f"{scale},setsar=1,fps={FPS},format=yuv420p,"
+        f"trim=duration={_fmt(duration)},setpts=PTS-STARTPTS"
+    )
+
+
+def _slide_position(transition: str, side: str, duration: float):
+    """
+    Overlay position expressions matching moviepy's vfx.SlideIn / vfx.SlideOut.
+    """
+    t = TRANSITION_DURATION
+    if transition == VideoTransitionMode.slide_in.value:
+        progress = f"(t/{t}-1)"
+        exprs = {
+            "left": (f"min(0,W*{progress})", "0"),
+            "right": (f"max(0,-W*{progress})", "0"),
+            "top": ("0", f"min(0,H*{progress})"),
+            "bottom": ("0", f"max(0,-H*{progress})"),
+        }
+    else:
+        progress = f"(t-{_fmt(duration - t)})/{t}"
+        exprs = {
+            "left": (f"min(0,-W*{progress})", "0"),
+            "right": (f"max(0,W*{progress})", "0"),
+            "top": ("0", f"min(0,-H*{progress})"),
+            "bottom": ("0", f"max(0,H*{progress})"),
+        }
+    return exprs.get(side, exprs["left"])
+
+
+def _segment_filters(
+    label: str,
+    input_index: int,
+    segment: timeline.Segment,
+    width: int,
+    height: int,
+) -> List[str]:
+    duration = segment.duration
+    transition = segment.transition
+    chain = f"[{input_index}:v]{_normalize_filter(width, height, duration, segment.scale_mode)}"
+
+    if transition == VideoTransitionMode.fade_in.value:
+        return [f"{chain},fade=t=in:st=0:d={TRANSITION_DURATION}[{label}]"]
+    if transition == VideoTransitionMode.fade_out.value:
+        start = max(0.0, duration - TRANSITION_DURATION)
+        return [f"{chain},fade=t=out:st={_fmt(start)}:d={TRANSITION_DURATION}[{label}]"]
+    if transition in (
+        VideoTransitionMode.slide_in.value,
+        VideoTransitionMode.slide_out.value,
+    ):
+        x, y = _slide_position(transition, segment.side, duration)
+        return [
+            f"{chain}[{label}fg]",
+            f"color=c=black:s={width}x{height}:r={FPS}:d={_fmt(duration)}[{label}bg]",
+            f"[{label}bg][{label}fg]overlay=x='{x}':y='{y}',format=yuv420p[{label}]",
+        ]
+    return [f"{chain}[{label}]"]
+
+
+def _render_subtitle_images(
+    subtitle_path: str, params: VideoParams, width: int, height: int, file_prefix: str
+) -> List[dict]:
+    """
+    Write each subtitle sprite into a transparent PNG, using the same styling as the
+    moviepy backend. The files are named `<file_prefix>.subtitle-N.png`.
+    """
+    if not params.subtitle_enabled:
+        return []
+
+    overlays = []
+    for idx, sprite in enumerate(
+        video.create_subtitle_sprites(subtitle_path, params, width, height)
+    ):
+        image_file = f"{file_prefix}.subtitle-{idx + 1}.png"
+        Image.fromarray(np.dstack([sprite.rgb, sprite.alpha]), "RGBA").save(image_file)
+        overlays.append(
+            {
+                "file": image_file,
+                "x": sprite.x,
+                "y": sprite.y,
+                "start": sprite.start,
+                "end": sprite.end,
+            }
+        )
+    return overlays
+
+
+def render_video(
+    output_file: str,
+    video_paths: List[str],
+    audio_path: str,
+    subtitle_path: str,
+    params: VideoParams,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    hook_file: str = "",
+) -> str:
+    """
+    Render the final video with a single ffmpeg invocation.
+    Returns the output file, or an empty string if ffmpeg failed.
+    """
+    aspect = VideoAspect(params.video_aspect)
+    width, height = aspect.to_resolution()
+
+    audio_duration = probe.duration(audio_path)
+    logger.info(f"start, video size: {width} x {height}, audio duration: {audio_duration}")
+    logger.info(f"  ① audio: {audio_path}")
+    logger.info(f"  ② subtitle: {subtitle_path}")
+    logger.info(f"  ③ hook: {hook_file}")
+    logger.info(f"  ④ output: {output_file}")
+
+    video_timeline = timeline.build(
+        video_paths=video_paths,
+        audio_duration=audio_duration,
+        width=width,
+        height=height,
+        video_concat_mode=video_concat_mode,
+        video_transition_mode=params.video_transition_mode,
+        max_clip_duration=params.video_clip_duration,
+        fps=FPS,
+    )
+    if not video_timeline.segments:
+        logger.error("no clips to render")
+        return ""
+    body_duration = video_timeline.duration
+
+    inputs = []
+    filters = []
+
+    # 1. video segments, trimmed at the demuxer so only the needed window is decoded
+    segment_labels = []
+    for segment in video_timeline.segments:
+        index = len(inputs)
+        inputs.append(
+            ["-ss", _fmt(segment.start), "-t", _fmt(segment.duration + 0.5), "-i", segment.source]
+        )
+        label = f"s{index}"
+        filters += _segment_filters(label, index, segment, width, height)
+        segment_labels.append(f"[{label}]")
+    filters.append(
+        f"{''.join(segment_labels)}concat=n={len(segment_labels)}:v=1:a=0[body0]"
+    )
+    body_label = "body0"
+
+    overlays = []
+    filter_script = f"{output_file}.filtergraph.txt"
+    try:
+        # 2. subtitles, burned in by libass or overlaid as images
+        if video.subtitle_render_mode() == video.SUBTITLE_MODE_ASS:
+            ass_file = ""
+            if params.subtitle_enabled:
+                ass_file = subtitle_ass.srt_to_ass(subtitle_path, params, width, height)
+            if ass_file:
+                filters.append(
+                    f"[{body_label}]{subtitle_ass.burn_filter(ass_file)}[body_sub]"
+                )
+                body_label = "body_sub"
+        else:
+            overlays = _render_subtitle_images(
+                subtitle_path, params, width, height, output_file
+            )
+        for idx, overlay in enumerate(overlays):
+            index = len(inputs)
+            inputs.append(["-i", overlay["file"]])
+            next_label = f"body{idx + 1}"
+            filters.append(
+                f"[{body_label}][{index}:v]overlay=x={overlay['x']}:y={overlay['y']}:"
+                f"enable='between(t,{_fmt(overlay['start'])},{_fmt(overlay['end'])})'[{next_label}]"
+            )
+            body_label = next_label
+
+        # 3. voice + bgm
+        voice_index = len(inputs)
+        inputs.append(["-i", audio_path])
+        filters.append(f"[{voice_index}:a]volume={params.voice_volume},{AUDIO_FORMAT}[voice]")
+        audio_label = "voice"
+        bgm_file = video.get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
+        if bgm_file:
+            bgm_index = len(inputs)
+            inputs.append(["-stream_loop", "-1", "-i", bgm_file])
+            fade_start = max(0.0, body_duration - BGM_FADE_OUT_DURATION)
+            filters.append(
+                f"[{bgm_index}:a]volume={params.bgm_volume},{AUDIO_FORMAT},"
+                f"atrim=duration={_fmt(body_duration)},"
+                f"afade=t=out:st={_fmt(fade_start)}:d={BGM_FADE_OUT_DURATION}[bgm]"
+            )
+            filters.append(
+                "[voice][bgm]amix=inputs=2:duration=first:dropout_transition=0:normalize=0[mix]"
+            )
+            audio_label = "mix"
+        filters.append(f"[{audio_label}]apad,atrim=duration={_fmt(body_duration)}[body_a]")
+
+        # 4. hook prefix
+        video_out, audio_out = body_label, "body_a"
+        if hook_file:
+            hook = timeline.hook_segment(hook_file, HOOK_MAX_DURATION)
+            hook_index = len(inputs)
+            inputs.append(["-t", _fmt(hook.duration), "-i", hook.source])
+            filters.append(
+                f"[{hook_index}:v]{_normalize_filter(width, height, hook.duration, hook.scale_mode)}[hook_v]"
+            )
+            if probe.probe(hook.source)["has_audio"]:
+                filters.append(
+                    f"[{hook_index}:a]{AUDIO_FORMAT},apad,atrim=duration={_fmt(hook.duration)}[hook_a]"
+                )
+            else:
+                filters.append(
+                    f"anullsrc=r=44100:cl=stereo,{AUDIO_FORMAT},atrim=duration={_fmt(hook.duration)}[hook_a]"
+                )
+            filters.append(f"[{body_label}]fade=t=in:st=0:d={TRANSITION_DURATION}[body_v]")
+            filters.append("[hook_v][hook_a][body_v][body_a]concat=n=2:v=1:a=1[vout][aout]")
+            video_out, audio_out = "vout", "aout"
+
+        with open(filter_script, "w", encoding="utf-8") as f:
+            f.write(";\n".join(filters))
+
+        cmd = [
+            FFMPEG_BINARY,
+            "-y",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            *[arg for input_args in inputs for arg in input_args],
+            "-filter_complex_script",
+            filter_script,
+            "-map",
+            f"[{video_out}]",
+            "-map",
+            f"[{audio_out}]",
+            "-c:v",
+            "libx264",
+            "-pix_fmt",
+            "yuv420p",
+            "-r",
+            str(FPS),
+            "-c:a",
+            "aac",
+            "-threads",
+            str(params.n_threads or 2),
+            "-movflags",
+            "+faststart",
+            output_file,
+        ]
+        logger.info(f"rendering {len(video_timeline.segments)} segments with ffmpeg")
+        logger.debug(" ".join(cmd))
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            logger.error(
+                f"ffmpeg render failed: {result.stderr.decode('utf-8', errors='ignore')}"
+            )
+            return ""
+
+        logger.success("completed")
+        return output_file
+    finally:
+        # also the sprites of a failed _render_subtitle_images
+        for file in glob.glob(f"{glob.escape(output_file)}.subtitle-*.png") + [filter_script]:
+            if os.path.exists(file):
+                os.remove(file)
@@ -1,63 +1,181 @@
 import json
 import os.path
-import re
+import threading
+from contextlib import contextmanager
 from timeit import default_timer as timer
 
 from faster_whisper import WhisperModel
 from loguru import logger
 
 from app.config import config
+from app.services import subtitle_cues
 from app.utils import utils
 
+try:
+    from rapidfuzz.distance import Levenshtein
+except ImportError:
+    # a declared dependency, levenshtein_distance is only the fallback without it
+    Levenshtein = None
+
 model_size = config.whisper.get("model_size", "large-v3")
 device = config.whisper.get("device", "cpu")
 compute_type = config.whisper.get("compute_type", "int8")
-model = None
 
+# Pool of loaded models. A WhisperModel is used by one transcription at a time, a
+# task that finds no idle model loads another one up to `pool_size`, then waits.
+_idle_models = []
+_model_count = 0  # loaded or being loaded
+_pool_condition = threading.Condition()
+_stats_lock = threading.Lock()
+_stats = {
+    "loads": 0,
+    "load_seconds": 0.0,
+    "transcriptions": 0,
+    "transcribe_seconds": 0.0,
+    "audio_seconds": 0.0,
+}
+
+
+def pool_size() -> int:
+    return max(1, int(config.whisper.get("pool_size", 1)))
+
+
+def _add_stats(**values):
+    with _stats_lock:
+        for name, value in values.items():
+            _stats[name] += value
+
+
+def stats() -> dict:
+    """
+    Load and inference timings of the model pool.
+    """
+    with _stats_lock:
+        result = dict(_stats)
+    with _pool_condition:
+        result["models"] = _model_count
+        result["idle_models"] = len(_idle_models)
+    return result
+
+
+def _load_model():
+    model_path = f"{utils.root_dir()}/models/whisper-{model_size}"
+    model_bin_file = f"{model_path}/model.bin"
+    if not os.path.isdir(model_path) or not os.path.isfile(model_bin_file):
+        model_path = model_size
 
-def create(audio_file, subtitle_file: str = ""):
-    global model
-    if not model:
-        model_path = f"{utils.root_dir()}/models/whisper-{model_size}"
-        model_bin_file = f"{model_path}/model.bin"
-        if not os.path.isdir(model_path) or not os.path.isfile(model_bin_file):
-            model_path = model_size
-
-        logger.info(
-            f"loading model: {model_path}, device: {device}, compute_type: {compute_type}"
+    logger.info(
+        f"loading model: {model_path}, device: {device}, compute_type: {compute_type}"
+    )
+    start = timer()
+    try:
+        model = WhisperModel(
+            model_size_or_path=model_path, device=device, compute_type=compute_type
         )
-        try:
-            model = WhisperModel(
-                model_size_or_path=model_path, device=device, compute_type=compute_type
-            )
-        except Exception as e:
-            logger.error(
-                f"failed to load model: {e} \n\n"
-                f"********************************************\n"
-                f"this may be caused by network issue. \n"
-                f"please download the model manually and put it in the 'models' folder. \n"
-                f"see [README.md FAQ](https://github.com/harry0703/MoneyPrinterTurbo) for more details.\n"
-                f"********************************************\n\n"
-            )
-            return None
+    except Exception as e:
+        logger.error(
+            f"failed to load model: {e} \n\n"
+            f"********************************************\n"
+            f"this may be caused by network issue. \n"
+            f"please download the model manually and put it in the 'models' folder. \n"
+            f"see [README.md FAQ](https://github.com/harry0703/MoneyPrinterTurbo) for more details.\n"
+            f"********************************************\n\n"
+        )
+        return None
+    elapsed = timer() - start
+    _add_stats(loads=1, load_seconds=elapsed)
+    logger.info(f"model loaded, elapsed: {elapsed:.2f} s")
+    return model
+
+
+@contextmanager
+def acquire_model():
+    """
+    Borrow a model from the pool, loading one if none is idle and the pool is not
+    full. Yields None if the model can not be loaded.
+    """
+    global _model_count
+    with _pool_condition:
+        while not _idle_models and _model_count >= pool_size():
+            _pool_condition.wait()
+        model = _idle_models.pop() if _idle_models else None
+        if model is None:
+            _model_count += 1
+
+    if model is None:
+        model = _load_model()
+        if model is None:
+            with _pool_condition:
+                _model_count -= 1
+                _pool_condition.notify()
+            yield None
+            return
+
+    try:
+        yield model
+    finally:
+        with _pool_condition:
+            _idle_models.append(model)
+            _pool_condition.notify()
+
 
+def preload():
+    """
+    Load a model ahead of the first whisper task.
+    """
+    with acquire_model():
+        pass
+
+
+def create(audio_file, subtitle_file: str = ""):
     logger.info(f"start, output file: {subtitle_file}")
     if not subtitle_file:
         subtitle_file = f"{audio_file}.srt"
 
+    if int(config.whisper.get("batch_size", 8)) > 0:
+        from app.services import transcription
+
+        subtitles = transcription.transcribe_file(audio_file)
+    else:
+        with acquire_model() as model:
+            subtitles = transcribe(model, audio_file) if model else None
+    if subtitles is None:
+        return None
+
+    cues = subtitle_cues.Cues()
+    for subtitle in subtitles:
+        text = subtitle.get("msg")
+        if text:
+            cues.append(
+                subtitle_cues.to_ms(subtitle.get("start_time")),
+                subtitle_cues.to_ms(subtitle.get("end_time")),
+                text,
+            )
+    subtitle_cues.save(cues, subtitle_file)
+    logger.info(f"subtitle file created: {subtitle_file}")
+    return cues
+
+
+def transcribe(model, audio, **options):
+    """
+    Transcribe an audio file or 16 kHz samples into sentence-level subtitle items.
+    `model` is a WhisperModel or a BatchedInferencePipeline wrapping one.
+    """
+    start = timer()
+    # segments are decoded lazily, the model stays borrowed until they are consumed
     segments, info = model.transcribe(
-        audio_file,
+        audio,
         beam_size=5,
         word_timestamps=True,
         vad_filter=True,
         vad_parameters=dict(min_silence_duration_ms=500),
+        **options,
     )
 
     logger.info(
         f"detected language: '{info.language}', probability: {info.language_probability:.2f}"
     )
 
-    start = timer()
     subtitles = []
 
     def recognized(seg_text, seg_start, seg_end):
@@ -116,166 +234,219 @@ def create(audio_file, subtitle_file: str = ""):
     end = timer()
 
     diff = end - start
-    logger.info(f"complete, elapsed: {diff:.2f} s")
-
-    idx = 1
-    lines = []
-    for subtitle in subtitles:
-        text = subtitle.get("msg")
-        if text:
-            lines.append(
-                utils.text_to_srt(
-                    idx, text, subtitle.get("start_time"), subtitle.get("end_time")
-                )
-            )
-            idx += 1
-
-    sub = "\n".join(lines) + "\n"
-    with open(subtitle_file, "w", encoding="utf-8") as f:
-        f.write(sub)
-    logger.info(f"subtitle file created: {subtitle_file}")
+    _add_stats(transcriptions=1, transcribe_seconds=diff, audio_seconds=info.duration)
+    logger.info(
+        f"complete, elapsed: {diff:.2f} s, audio: {info.duration:.2f} s, "
+        f"real-time factor: {diff / max(info.duration, 0.01):.2f}"
+    )
+    return subtitles
 
 
 def file_to_subtitles(filename):
-    if not filename or not os.path.isfile(filename):
+    cues = subtitle_cues.load(filename)
+    if not cues:
         return []
-
-    times_texts = []
-    current_times = None
-    current_text = ""
-    index = 0
-    with open(filename, "r", encoding="utf-8") as f:
-        for line in f:
-            times = re.findall("([0-9]*:[0-9]*:[0-9]*,[0-9]*)", line)
-            if times:
-                current_times = line
-            elif line.strip() == "" and current_times:
-                index += 1
-                times_texts.append((index, current_times.strip(), current_text.strip()))
-                current_times, current_text = None, ""
-            elif current_times:
-                current_text += line
-    return times_texts
+    return [
+        (
+            index,
+            f"{subtitle_cues.format_time(start)} --> {subtitle_cues.format_time(end)}",
+            text,
+        )
+        for index, (start, end, text) in enumerate(cues, start=1)
+    ]
 
 
 def levenshtein_distance(s1, s2):
+    """
+    Edit distance with Myers' bit-parallel algorithm: each row of the classic
+    table is one python integer, so the cost is len(s2) big-int steps instead
+    of len(s1) * len(s2) list operations.
+    """
     if len(s1) < len(s2):
-        return levenshtein_distance(s2, s1)
-
+        s1, s2 = s2, s1
     if len(s2) == 0:
         return len(s1)
 
-    previous_row = range(len(s2) + 1)
-    for i, c1 in enumerate(s1):
-        current_row = [i + 1]
-        for j, c2 in enumerate(s2):
-            insertions = previous_row[j + 1] + 1
-            deletions = current_row[j] + 1
-            substitutions = previous_row[j] + (c1 != c2)
-            current_row.append(min(insertions, deletions, substitutions))
-        previous_row = current_row
-
-    return previous_row[-1]
+    # s2 is the pattern, one bit per character
+    peq = {}
+    for i, c in enumerate(s2):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    mask = (1 << len(s2)) - 1
+    high = 1 << (len(s2) - 1)
+    pv, mv, distance = mask, 0, len(s2)
+    for c in s1:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            distance += 1
+        elif mh & high:
+            distance -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return distance
 
 
 def similarity(a, b):
-    distance = levenshtein_distance(a.lower(), b.lower())
     max_length = max(len(a), len(b))
+    if not max_length:
+        return 1.0
+    if Levenshtein:
+        return Levenshtein.normalized_similarity(a.lower(), b.lower())
+    distance = levenshtein_distance(a.lower(), b.lower())
     return 1 - (distance / max_length)
 
 
-def correct(subtitle_file, video_script):
-    subtitle_items = file_to_subtitles(subtitle_file)
-    script_lines = utils.split_string_by_punctuations(video_script)
+# subtitle items merged into one script line at most
+MAX_MERGE = 4
+# half width of the band of subtitle items searched around the diagonal
+ALIGNMENT_BAND = 16
+# milliseconds shown per script line that is left after the end of the transcription
+TRAILING_LINE_DURATION = 1500
+
+
+def align(script_lines, subtitle_texts):
+    """
+    Global alignment of script lines to whisper subtitle items in one banded
+    dynamic-programming pass. Each script line takes a run of up to MAX_MERGE
+    consecutive items, or none; items may also be left out. The total similarity
+    is maximized. Returns a list of (first item, end item, score) per line, with
+    None for lines that took no item.
+    """
+    n, m = len(script_lines), len(subtitle_texts)
+    if not n:
+        return []
+    # wide enough for the diagonal to move by m / n items per line
+    width = ALIGNMENT_BAND + MAX_MERGE + m // n
+    scores = [dict() for _ in range(n + 1)]
+    moves = [dict() for _ in range(n + 1)]
+    for i in range(n + 1):
+        center = round(i * m / n)
+        line = script_lines[i - 1] if i else ""
+        for j in range(max(0, center - width), min(m, center + width) + 1):
+            if i == 0 and j == 0:
+                scores[0][0] = 0.0
+                continue
+            best, move = float("-inf"), None
+            # leave item j-1 out
+            if j and j - 1 in scores[i] and scores[i][j - 1] > best:
+                best, move = scores[i][j - 1], (i, j - 1, 0.0)
+            if i:
+                # line i-1 takes no item
+                if j in scores[i - 1] and scores[i - 1][j] > best:
+                    best, move = scores[i - 1][j], (i - 1, j, 0.0)
+                # line i-1 takes items j-k .. j-1
+                merged = ""
+                for k in range(1, min(MAX_MERGE, j) + 1):
+                    merged = f"{subtitle_texts[j - k]} {merged}".strip()
+                    if j - k not in scores[i - 1]:
+                        continue
+                    score = similarity(line, merged)
+                    if scores[i - 1][j - k] + score > best:
+                        best, move = scores[i - 1][j - k] + score, (i - 1, j - k, score)
+                    if len(merged) > 2 * len(line):
+                        break
+            if move:
+                scores[i][j] = best
+                moves[i][j] = move
+
+    groups = [None] * n
+    i, j = n, m
+    while (i, j) != (0, 0):
+        previous_i, previous_j, score = moves[i][j]
+        if previous_i != i and previous_j != j:
+            groups[previous_i] = (previous_j, j, score)
+        i, j = previous_i, previous_j
+    return groups
+
+
+def correct(subtitle_file, video_script, audio_duration: float = 0.0):
+    """
+    Replace the whisper transcription in the subtitle file with the script lines,
+    timed by the subtitle items each line aligns to. Script lines after the last
+    aligned one share the time up to audio_duration (seconds).
+    Returns alignment metrics, or None if there is no transcription to correct.
+    """
+    cues = subtitle_cues.load(subtitle_file)
+    if not cues:
+        logger.warning(f"no subtitle items to correct: {subtitle_file}")
+        return None
+    script_lines = [
+        video_script[start:end] for start, end in utils.sentence_spans(video_script)
+    ]
+    subtitle_texts = [text.strip() for text in cues.texts]
+
+    start = timer()
+    groups = align(script_lines, subtitle_texts)
+    elapsed = timer() - start
 
     corrected = False
-    new_subtitle_items = []
-    script_index = 0
-    subtitle_index = 0
-
-    while script_index < len(script_lines) and subtitle_index < len(subtitle_items):
-        script_line = script_lines[script_index].strip()
-        subtitle_line = subtitle_items[subtitle_index][2].strip()
-
-        if script_line == subtitle_line:
-            new_subtitle_items.append(subtitle_items[subtitle_index])
-            script_index += 1
-            subtitle_index += 1
-        else:
-            combined_subtitle = subtitle_line
-            start_time = subtitle_items[subtitle_index][1].split(" --> ")[0]
-            end_time = subtitle_items[subtitle_index][1].split(" --> ")[1]
-            next_subtitle_index = subtitle_index + 1
-
-            while next_subtitle_index < len(subtitle_items):
-                next_subtitle = subtitle_items[next_subtitle_index][2].strip()
-                if similarity(
-                    script_line, combined_subtitle + " " + next_subtitle
-                ) > similarity(script_line, combined_subtitle):
-                    combined_subtitle += " " + next_subtitle
-                    end_time = subtitle_items[next_subtitle_index][1].split(" --> ")[1]
-                    next_subtitle_index += 1
-                else:
-                    break
-
-            if similarity(script_line, combined_subtitle) > 0.8:
-                logger.warning(
-                    f"Merged/Corrected - Script: {script_line}, Subtitle: {combined_subtitle}"
-                )
-                new_subtitle_items.append(
-                    (
-                        len(new_subtitle_items) + 1,
-                        f"{start_time} --> {end_time}",
-                        script_line,
-                    )
-                )
+    new_cues = subtitle_cues.Cues()
+    previous_end = 0
+    i = 0
+    while i < len(script_lines):
+        group = groups[i]
+        if group:
+            first, end, score = group
+            if end - first != 1 or subtitle_texts[first] != script_lines[i]:
                 corrected = True
-            else:
-                logger.warning(
-                    f"Mismatch - Script: {script_line}, Subtitle: {combined_subtitle}"
-                )
-                new_subtitle_items.append(
-                    (
-                        len(new_subtitle_items) + 1,
-                        f"{start_time} --> {end_time}",
-                        script_line,
+                if score < 0.8:
+                    logger.warning(
+                        f"Mismatch - Script: {script_lines[i]}, Subtitle: {' '.join(subtitle_texts[first:end])}, score: {score:.2f}"
                     )
-                )
-                corrected = True
+            new_cues.append(cues.starts[first], cues.ends[end - 1], script_lines[i])
+            previous_end = cues.ends[end - 1]
+            i += 1
+            continue
 
-            script_index += 1
-            subtitle_index = next_subtitle_index
-
-    # Process the remaining lines of the script.
-    while script_index < len(script_lines):
-        logger.warning(f"Extra script line: {script_lines[script_index]}")
-        if subtitle_index < len(subtitle_items):
-            new_subtitle_items.append(
-                (
-                    len(new_subtitle_items) + 1,
-                    subtitle_items[subtitle_index][1],
-                    script_lines[script_index],
-                )
-            )
-            subtitle_index += 1
+        # lines without subtitle items share the time up to the next aligned line
+        corrected = True
+        j = i
+        while j < len(script_lines) and not groups[j]:
+            logger.warning(f"Extra script line: {script_lines[j]}")
+            j += 1
+        if j < len(script_lines):
+            gap_end = cues.starts[groups[j][0]]
         else:
-            new_subtitle_items.append(
-                (
-                    len(new_subtitle_items) + 1,
-                    "00:00:00,000 --> 00:00:00,000",
-                    script_lines[script_index],
-                )
-            )
-        script_index += 1
+            gap_end = max(cues.duration, subtitle_cues.to_ms(audio_duration))
+            if gap_end <= previous_end:
+                # nothing left to share, keep the trailing lines readable
+                gap_end = previous_end + TRAILING_LINE_DURATION * (j - i)
+        step = max(gap_end - previous_end, 0) // (j - i)
+        for k in range(i, j):
+            new_cues.append(previous_end, previous_end + step, script_lines[k])
+            previous_end += step
+        i = j
+
+    aligned_items = sum(end - first for first, end, _ in filter(None, groups))
+    scores = [group[2] for group in groups if group]
+    metrics = {
+        "script_lines": len(script_lines),
+        "subtitle_items": len(cues),
+        "aligned_lines": len(scores),
+        "skipped_items": len(cues) - aligned_items,
+        "mean_score": sum(scores) / len(scores) if scores else 0.0,
+        "min_score": min(scores) if scores else 0.0,
+        "elapsed": elapsed,
+    }
+    if metrics["skipped_items"]:
         corrected = True
+    logger.info(
+        "alignment: {aligned_lines}/{script_lines} lines aligned to {subtitle_items} items, "
+        "skipped items: {skipped_items}, mean score: {mean_score:.3f}, min score: {min_score:.3f}, "
+        "elapsed: {elapsed:.3f} s".format(**metrics)
+    )
 
     if corrected:
-        with open(subtitle_file, "w", encoding="utf-8") as fd:
-            for i, item in enumerate(new_subtitle_items):
-                fd.write(f"{i + 1}\n{item[1]}\n{item[2]}\n\n")
+        subtitle_cues.save(new_cues, subtitle_file)
         logger.info("Subtitle corrected")
     else:
         logger.success("Subtitle is correct")
+    return metrics
 
 
 if __name__ == "__main__":
@@ -0,0 +1,159 @@
+"""
+Styled ASS subtitles, burned in by ffmpeg's libass `subtitles` filter.
+
+The cues produced by voice.create_subtitle / subtitle.create are written as an ASS
+file carrying the task's font, size, colours, stroke and position, so the encoder
+draws the subtitles itself and no per-frame compositing happens in Python.
+"""
+
+import os
+
+from app.models.schema import VideoParams
+from app.services import subtitle_cues, video
+from app.utils import utils
+
+_TRANSPARENT_COLORS = {"", "transparent", "none"}
+
+
+def ass_color(color: str, alpha: int = 0) -> str:
+    """
+    "#RRGGBB" => "&HAABBGGRR", alpha 0 is opaque.
+    """
+    color = (color or "#FFFFFF").lstrip("#")
+    if len(color) == 3:
+        color = "".join(c * 2 for c in color)
+    r, g, b = color[0:2], color[2:4], color[4:6]
+    return f"&H{alpha:02X}{b}{g}{r}".upper()
+
+
+def ass_timestamp(ms: int) -> str:
+    centiseconds = int(round(ms / 10))
+    h, centiseconds = divmod(centiseconds, 360000)
+    m, centiseconds = divmod(centiseconds, 6000)
+    s, centiseconds = divmod(centiseconds, 100)
+    return f"{h}:{m:02d}:{s:02d}.{centiseconds:02d}"
+
+
+def _escape(text: str) -> str:
+    return text.replace("{", "\\{").replace("}", "\\}")
+
+
+def _escape_filter_value(value: str, specials: str) -> str:
+    for char in "\\" + specials:
+        value = value.replace(char, f"\\{char}")
+    return value
+
+
+def filter_path(file: str) -> str:
+    """
+    Escape a path for use as a filter option inside a filtergraph: once for the
+    option parser, then once more for the filtergraph parser.
+    """
+    file = os.path.abspath(file).replace("\\", "/")
+    file = _escape_filter_value(file, "':")
+    return _escape_filter_value(file, "',;[]")
+
+
+def burn_filter(ass_file: str) -> str:
+    return (
+        f"subtitles=filename={filter_path(ass_file)}"
+        f":fontsdir={filter_path(utils.font_dir())}"
+    )
+
+
+def srt_to_ass(
+    subtitle_path: str,
+    params: VideoParams,
+    video_width: int,
+    video_height: int,
+    ass_file: str = "",
+) -> str:
+    """
+    Convert the SRT into an ASS file styled like the moviepy subtitles.
+    Lines are wrapped with video.wrap_text so line breaks match the other modes.
+    Returns the ASS file, or an empty string if there is nothing to burn in.
+    """
+    cues = subtitle_cues.load(subtitle_path)
+    if not cues:
+        return ""
+    if not ass_file:
+        ass_file = f"{os.path.splitext(subtitle_path)[0]}.ass"
+
+    font_path = video.get_font_path(params)
+    font_size = int(params.font_size)
+    font = video.load_font(font_path, font_size)
+    font_name = font.getname()[0]
+    # libass sizes the font by its line height (ascent + descent), pillow by the em
+    ass_font_size = sum(font.getmetrics())
+    max_width = video_width * 0.9
+
+    background = params.text_background_color
+    has_background = (
+        isinstance(background, str)
+        and background.strip().lower() not in _TRANSPARENT_COLORS
+    )
+    if has_background:
+        # opaque box, drawn with the outline colour
+        border_style, outline_color, outline = 3, ass_color(background), 4
+    else:
+        border_style = 1
+        outline_color = ass_color(params.stroke_color)
+        outline = params.stroke_width
+
+    margin_v = 0
+    if params.subtitle_position == "bottom":
+        alignment, margin_v = 2, int(video_height * 0.15)
+    elif params.subtitle_position in ("top", "custom"):
+        alignment, margin_v = 8, int(video_height * 0.05)
+    else:  # center
+        alignment = 5
+
+    def position_tag(text: str, line_count: int) -> str:
+        if params.subtitle_position != "custom":
+            return ""
+        # \\pos anchors the line box at its ascender, place the glyphs like the sprites
+        # do and keep them inside the frame
+        _, top, _, bottom = font.getbbox(text)
+        height = (line_count - 1) * ass_font_size + bottom - top
+        margin = 10
+        y = (video_height - height) * (params.custom_position / 100)
+        y = max(margin, min(y, video_height - height - margin))
+        return f"{{\\an8\\pos({video_width // 2},{int(y - top)})}}"
+
+    lines = [
+        "[Script Info]",
+        "ScriptType: v4.00+",
+        f"PlayResX: {video_width}",
+        f"PlayResY: {video_height}",
+        "WrapStyle: 2",
+        "ScaledBorderAndShadow: yes",
+        "",
+        "[V4+ Styles]",
+        "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, "
+        "Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, "
+        "Shadow, Alignment, MarginL, MarginR, MarginV, Encoding",
+        f"Style: Default,{font_name},{ass_font_size},{ass_color(params.text_fore_color)},"
+        f"{ass_color(params.text_fore_color)},{outline_color},&H00000000,"
+        f"0,0,0,0,100,100,0,0,{border_style},{outline},0,{alignment},"
+        f"{int(video_width * 0.05)},{int(video_width * 0.05)},{margin_v},1",
+        "",
+        "[Events]",
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text",
+    ]
+    for start_time, end_time, text in cues:
+        if end_time <= start_time:
+            continue
+        wrapped_txt, _ = video.wrap_text(
+            text, max_width=max_width, font=font_path, fontsize=font_size
+        )
+        wrapped_lines = wrapped_txt.split("\n")
+        tag = position_tag(text.strip(), len(wrapped_lines))
+        text = "\\N".join(_escape(line) for line in wrapped_lines)
+        lines.append(
+            f"Dialogue: 0,{ass_timestamp(start_time)},{ass_timestamp(end_time)},"
+            f"Default,,0,0,0,,{tag}{text}"
+        )
+
+    with open(ass_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    return ass_file
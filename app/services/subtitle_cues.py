@@ -0,0 +1,170 @@
+"""
+Compact in-memory subtitle cues.
+
+Cues keeps start and end times as int millisecond arrays next to the texts, and is
+what the subtitle stages build and hand on. SRT/VTT text is only produced when a
+file is written for the user or the encoder (ASS lives in subtitle_ass). The most
+recently saved files are remembered by path, size and mtime, so the stages that
+later load the same subtitle file get a copy of the cues without parsing it
+again, and times never go through float -> string -> float conversions.
+"""
+
+import os
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+_time_pattern = re.compile(r"(\d+):(\d{1,2}):(\d{1,2})(?:[,.](\d{1,3}))?")
+
+# the subtitle files of the most recent tasks
+_CACHE_SIZE = 32
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+class Cues:
+    __slots__ = ("starts", "ends", "texts")
+
+    def __init__(self):
+        self.starts = array("q")
+        self.ends = array("q")
+        self.texts: List[str] = []
+
+    def append(self, start: int, end: int, text: str):
+        """
+        Add a cue, start and end in milliseconds.
+        """
+        self.starts.append(int(start))
+        self.ends.append(int(end))
+        self.texts.append(text)
+
+    def copy(self) -> "Cues":
+        cues = Cues()
+        cues.starts = array("q", self.starts)
+        cues.ends = array("q", self.ends)
+        cues.texts = list(self.texts)
+        return cues
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __iter__(self) -> Iterator[Tuple[int, int, str]]:
+        return zip(self.starts, self.ends, self.texts)
+
+    @property
+    def duration(self) -> int:
+        return max(self.ends) if self.ends else 0
+
+    def items(self) -> List[Tuple[Tuple[float, float], str]]:
+        """
+        ((start, end), text) in seconds, the layout of moviepy's file_to_subtitles.
+        """
+        return [((start / 1000, end / 1000), text) for start, end, text in self]
+
+
+def to_ms(seconds: float) -> int:
+    return int(round(seconds * 1000))
+
+
+def format_time(ms: int, separator: str = ",") -> str:
+    hours, ms = divmod(int(ms), 3600000)
+    minutes, ms = divmod(ms, 60000)
+    seconds, ms = divmod(ms, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{ms:03d}"
+
+
+def parse_time(text: str) -> int:
+    match = _time_pattern.search(text)
+    if not match:
+        raise ValueError(f"invalid subtitle time: {text}")
+    hours, minutes, seconds, fraction = match.groups()
+    ms = int((fraction or "0").ljust(3, "0"))
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + ms
+
+
+def to_srt(cues: Cues) -> str:
+    blocks = [
+        f"{i}\n{format_time(start)} --> {format_time(end)}\n{text}\n"
+        for i, (start, end, text) in enumerate(cues, start=1)
+    ]
+    return "\n".join(blocks)
+
+
+def to_vtt(cues: Cues) -> str:
+    blocks = ["WEBVTT\n"] + [
+        f"{format_time(start, '.')} --> {format_time(end, '.')}\n{text}\n"
+        for start, end, text in cues
+    ]
+    return "\n".join(blocks)
+
+
+def parse(text: str) -> Cues:
+    """
+    Parse SRT or VTT text. Blocks without a time line are skipped.
+    """
+    cues = Cues()
+    for block in re.split(r"\n\s*\n", text.replace("\r\n", "\n").strip()):
+        lines = block.split("\n")
+        for i, line in enumerate(lines):
+            if "-->" in line:
+                start, _, end = line.partition("-->")
+                content = "\n".join(lines[i + 1 :]).strip()
+                cues.append(parse_time(start), parse_time(end), content)
+                break
+    return cues
+
+
+def _signature(file: str):
+    stat = os.stat(file)
+    return stat.st_size, stat.st_mtime
+
+
+def _remember(path: str, signature, cues: Cues):
+    with _lock:
+        _cache[path] = (signature, cues)
+        _cache.move_to_end(path)
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def save(cues: Cues, file: str) -> str:
+    """
+    Write the cues as SRT, or VTT if the file ends with .vtt.
+    """
+    content = to_vtt(cues) if file.lower().endswith(".vtt") else to_srt(cues)
+    with open(file, "w", encoding="utf-8") as f:
+        f.write(content)
+    _remember(os.path.abspath(file), _signature(file), cues.copy())
+    return file
+
+
+def load(file: str) -> Optional[Cues]:
+    """
+    The cues of a subtitle file, from memory if this process recently saved or
+    loaded the file as it is now. Each call returns its own copy.
+    None if the file does not exist or can not be parsed.
+    """
+    if not file or not os.path.isfile(file):
+        return None
+    path = os.path.abspath(file)
+    signature = _signature(path)
+    with _lock:
+        cached = _cache.get(path)
+        if cached:
+            _cache.move_to_end(path)
+    if cached and cached[0] == signature:
+        return cached[1].copy()
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            cues = parse(f.read())
+    except Exception as e:
+        logger.error(f"failed to parse subtitle file: {path} => {str(e)}")
+        return None
+    _remember(path, signature, cues)
+    return cues.copy()
@@ -2,20 +2,36 @@ import math
 import os.path
 import re
 import csv
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from os import path
 
+from edge_tts import SubMaker
 from loguru import logger
 
 from app.config import config
 from app.models import const
 from app.models.schema import VideoConcatMode, VideoParams
-from app.services import llm, material, subtitle, video, voice, youtube
+from app.services import checkpoint, llm, material, probe, renderer, subtitle, subtitle_cues, timeline, video, voice, youtube
 from app.services import state as sm
 from app.utils import utils
 
+# the estimated speech duration is padded, so the prefetch rarely needs a top-up
+PREFETCH_DURATION_MARGIN = 1.2
+
 
 def generate_script(task_id, params):
+    stage_key = checkpoint.key(
+        params.video_subject,
+        params.video_script,
+        params.video_language,
+        params.paragraph_number,
+    )
+    saved = checkpoint.load(task_id, "script", stage_key)
+    if saved:
+        return saved["script"]
+
     logger.info("\n\n## generating video script")
     video_script = params.video_script.strip()
     if not video_script:
@@ -32,10 +48,17 @@ def generate_script(task_id, params):
         logger.error("failed to generate video script.")
         return None
 
+    if "Error: " not in video_script:
+        checkpoint.save(task_id, "script", stage_key, {"script": video_script})
     return video_script
 
 
 def generate_terms(task_id, params, video_script):
+    stage_key = checkpoint.key(video_script, params.video_terms)
+    saved = checkpoint.load(task_id, "terms", stage_key)
+    if saved:
+        return saved["terms"]
+
     logger.info("\n\n## generating video terms")
     video_terms = params.video_terms
     if not video_terms:
@@ -59,6 +82,7 @@ def generate_terms(task_id, params, video_script):
         logger.error("failed to generate video terms.")
         return None
 
+    checkpoint.save(task_id, "terms", stage_key, {"terms": video_terms})
     return video_terms
 
 
@@ -75,8 +99,16 @@ def save_script_data(task_id, video_script, video_terms, params):
 
 
 def generate_audio(task_id, params, video_script):
-    logger.info("\n\n## generating audio")
     audio_file = path.join(utils.task_dir(task_id), "audio.mp3")
+    stage_key = checkpoint.key(video_script, params.voice_name, params.voice_rate)
+    saved = checkpoint.load(task_id, "audio", stage_key)
+    if saved:
+        sub_maker = SubMaker()
+        sub_maker.offset = [tuple(offset) for offset in saved["offset"]]
+        sub_maker.subs = saved["subs"]
+        return audio_file, saved["audio_duration"], sub_maker
+
+    logger.info("\n\n## generating audio")
     sub_maker = voice.tts(
         text=video_script,
         voice_name=voice.parse_voice_name(params.voice_name),
@@ -93,7 +125,19 @@ def generate_audio(task_id, params, video_script):
         )
         return None, None, None
 
-    audio_duration = math.ceil(voice.get_audio_duration(sub_maker))
+    # the last word boundary misses trailing silence, measure the file itself
+    audio_duration = math.ceil(probe.duration(audio_file))
+    checkpoint.save(
+        task_id,
+        "audio",
+        stage_key,
+        {
+            "audio_duration": audio_duration,
+            "offset": sub_maker.offset,
+            "subs": sub_maker.subs,
+        },
+        files=[audio_file],
+    )
     return audio_file, audio_duration, sub_maker
 
 
@@ -104,28 +148,45 @@ def generate_subtitle(task_id, params, video_script, sub_maker, audio_file):
     subtitle_path = path.join(utils.task_dir(task_id), "subtitle.srt")
     subtitle_provider = config.app.get(
         "subtitle_provider", "edge").strip().lower()
+    stage_key = checkpoint.key(
+        video_script, checkpoint.file_signature(audio_file), subtitle_provider
+    )
+    saved = checkpoint.load(task_id, "subtitle", stage_key)
+    if saved:
+        return saved["subtitle_path"]
+
     logger.info(f"\n\n## generating subtitle, provider: {subtitle_provider}")
 
     subtitle_fallback = False
     if subtitle_provider == "edge":
-        voice.create_subtitle(
+        cues = voice.create_subtitle(
             text=video_script, sub_maker=sub_maker, subtitle_file=subtitle_path
         )
-        if not os.path.exists(subtitle_path):
+        if not cues:
             subtitle_fallback = True
-            logger.warning("subtitle file not found, fallback to whisper")
+            logger.warning("word timings could not be aligned, fallback to whisper")
 
     if subtitle_provider == "whisper" or subtitle_fallback:
         subtitle.create(audio_file=audio_file, subtitle_file=subtitle_path)
         logger.info("\n\n## correcting subtitle")
-        subtitle.correct(subtitle_file=subtitle_path,
-                         video_script=video_script)
+        subtitle.correct(
+            subtitle_file=subtitle_path,
+            video_script=video_script,
+            audio_duration=probe.duration(audio_file),
+        )
 
-    subtitle_lines = subtitle.file_to_subtitles(subtitle_path)
-    if not subtitle_lines:
+    # cues written above are served from memory, not parsed again
+    if not subtitle_cues.load(subtitle_path):
         logger.warning(f"subtitle file is invalid: {subtitle_path}")
         return ""
 
+    checkpoint.save(
+        task_id,
+        "subtitle",
+        stage_key,
+        {"subtitle_path": subtitle_path},
+        files=[subtitle_path],
+    )
     return subtitle_path
 
 
@@ -162,6 +223,70 @@ def get_video_materials(task_id, params, video_terms, audio_duration):
         return downloaded_videos
 
 
+def prefetch_video_materials(task_id, params, video_terms, video_script):
+    """
+    Start downloading materials in the background, budgeted by the estimated speech
+    duration of the script, while the audio and subtitle are generated.
+    Returns (future, cancel_event).
+    """
+    estimated_duration = voice.estimate_duration(video_script, params.voice_rate)
+    estimated_duration = math.ceil(estimated_duration * PREFETCH_DURATION_MARGIN)
+    logger.info(
+        f"\n\n## prefetching materials, estimated audio duration: {estimated_duration} seconds"
+    )
+    cancel_event = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(
+        material.download_videos,
+        task_id=task_id,
+        search_terms=video_terms,
+        source=params.video_source,
+        video_aspect=params.video_aspect,
+        video_contact_mode=params.video_concat_mode,
+        audio_duration=estimated_duration * params.video_count,
+        max_clip_duration=params.video_clip_duration,
+        cancel_event=cancel_event,
+    )
+    executor.shutdown(wait=False)
+    return future, cancel_event
+
+
+def collect_video_materials(
+    task_id, params, video_terms, audio_duration, prefetch: Future
+):
+    """
+    Wait for the prefetched materials and top them up if the real audio turned out
+    longer than estimated. Already downloaded clips are served from the material
+    index and cache, so the top-up only fetches what is missing.
+    """
+    try:
+        downloaded_videos = prefetch.result()
+    except Exception as e:
+        logger.error(f"failed to prefetch materials: {str(e)}")
+        downloaded_videos = []
+
+    required_duration = audio_duration * params.video_count
+    found_duration = 0.0
+    for video_path in downloaded_videos:
+        try:
+            found_duration += min(
+                params.video_clip_duration, probe.probe(video_path)["duration"]
+            )
+        except Exception as e:
+            logger.warning(f"failed to probe material: {video_path} => {str(e)}")
+
+    if downloaded_videos and found_duration > required_duration:
+        logger.info(
+            f"prefetched materials cover the audio: {found_duration} / {required_duration} seconds"
+        )
+        return downloaded_videos
+
+    logger.info(
+        f"prefetched materials are not enough: {found_duration} / {required_duration} seconds, topping up"
+    )
+    return get_video_materials(task_id, params, video_terms, audio_duration)
+
+
 def save_video_export_data(task_id: str, video_path: str, params: VideoParams, video_script: str):
     """Save video export data to a CSV file in the storage directory."""
     csv_path = utils.storage_dir('video_exports.csv')
@@ -260,6 +385,43 @@ def safe_cleanup_task_dir(task_id, max_retries=5):
     return False
 
 
+def generate_video_variants(
+    task_id, params, downloaded_videos, audio_file, subtitle_path
+):
+    """
+    Render all the variants of a task in one batch, sharing the decoded audio,
+    subtitle overlays and normalized clips.
+    """
+    output_files = [
+        path.join(utils.final_videos_dir(), f"{task_id}-{i + 1}.mp4")
+        for i in range(params.video_count)
+    ]
+    logger.info(f"\n\n## generating {params.video_count} video variants")
+    variant_files = video.generate_video_variants(
+        video_paths=downloaded_videos,
+        audio_path=audio_file,
+        subtitle_path=subtitle_path,
+        output_files=output_files,
+        params=params,
+        video_concat_mode=VideoConcatMode.random,
+        workers=config.app.get("video_variant_workers", 0),
+    )
+    sm.state.update_task(task_id, progress=90)
+
+    final_video_paths = []
+    for final_video_path in variant_files:
+        if params.use_transitional_hook:
+            logger.info(f"\n\n## adding hook video to: {final_video_path}")
+            final_video_path = video.add_hook_video(
+                final_video_path=final_video_path,
+                video_aspect=params.video_aspect,
+                threads=params.n_threads,
+                specific_hook=params.specific_hook,
+            )
+        final_video_paths.append(final_video_path)
+    return final_video_paths
+
+
 def generate_final_videos(
     task_id, params, downloaded_videos, audio_file, subtitle_path, video_script=None
 ):
@@ -268,55 +430,128 @@ def generate_final_videos(
         params.video_concat_mode if params.video_count == 1 else VideoConcatMode.random
     )
     video_transition_mode = params.video_transition_mode
+    render_backend = config.app.get("video_render_backend", "moviepy").strip().lower()
 
     _progress = 50
-    for i in range(params.video_count):
-        index = i + 1
-        combined_video_path = path.join(
-            utils.task_dir(task_id), f"combined-{index}.mp4"
-        )
-        logger.info(
-            f"\n\n## combining video: {index} => {combined_video_path}")
-        video.combine_videos(
-            combined_video_path=combined_video_path,
-            video_paths=downloaded_videos,
-            audio_file=audio_file,
-            video_aspect=params.video_aspect,
-            video_concat_mode=video_concat_mode,
-            video_transition_mode=video_transition_mode,
-            max_clip_duration=params.video_clip_duration,
-            threads=params.n_threads,
-        )
-
-        _progress += 50 / params.video_count / 2
-        sm.state.update_task(task_id, progress=_progress)
-
-        final_video_path = path.join(
-            utils.final_videos_dir(), f"{task_id}-{index}.mp4")
-
-        logger.info(f"\n\n## generating video: {index} => {final_video_path}")
-        video.generate_video(
-            video_path=combined_video_path,
-            audio_path=audio_file,
-            subtitle_path=subtitle_path,
-            output_file=final_video_path,
-            params=params,
+    if render_backend != "ffmpeg" and params.video_count > 1:
+        final_video_paths = generate_video_variants(
+            task_id, params, downloaded_videos, audio_file, subtitle_path
         )
+        final_video_path = final_video_paths[-1] if final_video_paths else ""
+    else:
+        for i in range(params.video_count):
+            index = i + 1
+            if render_backend == "ffmpeg":
+                hook_file = ""
+                if params.use_transitional_hook:
+                    hook_file = video.get_hook_file(params.specific_hook)
+                final_video_path = path.join(
+                    utils.final_videos_dir(),
+                    f"{task_id}-{index}-with-hook.mp4" if hook_file else f"{task_id}-{index}.mp4",
+                )
+                logger.info(
+                    f"\n\n## rendering video with ffmpeg: {index} => {final_video_path}")
+                final_video_path = renderer.render_video(
+                    output_file=final_video_path,
+                    video_paths=downloaded_videos,
+                    audio_path=audio_file,
+                    subtitle_path=subtitle_path,
+                    params=params,
+                    video_concat_mode=video_concat_mode,
+                    hook_file=hook_file,
+                )
+
+                _progress += 50 / params.video_count
+                sm.state.update_task(task_id, progress=_progress)
+                if final_video_path:
+                    final_video_paths.append(final_video_path)
+                continue
+
+            combined_video_path = path.join(
+                utils.task_dir(task_id), f"combined-{index}.mp4"
+            )
+            timeline_path = path.join(
+                utils.task_dir(task_id), f"combined-{index}.json"
+            )
+            workers = config.app.get("video_render_workers", 0)
+            combined_key = checkpoint.key(
+                downloaded_videos,
+                checkpoint.file_signature(audio_file),
+                params.video_aspect,
+                video_concat_mode,
+                video_transition_mode,
+                params.video_clip_duration,
+            )
+            combined = checkpoint.load(task_id, f"combined-{index}", combined_key)
+            if combined is None:
+                logger.info(
+                    f"\n\n## combining video: {index} => {combined_video_path}")
+                video_timeline = video.build_timeline(
+                    video_paths=downloaded_videos,
+                    audio_file=audio_file,
+                    video_aspect=params.video_aspect,
+                    video_concat_mode=video_concat_mode,
+                    video_transition_mode=video_transition_mode,
+                    max_clip_duration=params.video_clip_duration,
+                )
+                video_timeline.save(timeline_path)
+                combined = {"timeline_path": timeline_path}
+                files = [timeline_path]
+                # otherwise generate_video composes the timeline, nothing to encode twice
+                if video.prerender(video_timeline, workers):
+                    video.render_timeline(
+                        video_timeline,
+                        combined_video_path,
+                        threads=params.n_threads,
+                        workers=workers,
+                    )
+                    combined["combined_video_path"] = combined_video_path
+                    files.append(combined_video_path)
+                else:
+                    video.normalize_segments(
+                        video_timeline.segments,
+                        video_timeline.width,
+                        video_timeline.height,
+                        threads=params.n_threads or 2,
+                        workers=video.segment_workers(video_timeline, workers),
+                    )
+                checkpoint.save(
+                    task_id, f"combined-{index}", combined_key, combined, files=files
+                )
+
+            _progress += 50 / params.video_count / 2
+            sm.state.update_task(task_id, progress=_progress)
+
+            final_video_path = path.join(
+                utils.final_videos_dir(), f"{task_id}-{index}.mp4")
+
+            logger.info(f"\n\n## generating video: {index} => {final_video_path}")
+            video_timeline = None
+            if "combined_video_path" not in combined:
+                video_timeline = timeline.Timeline.load(combined["timeline_path"])
+            video.generate_video(
+                video_path=combined.get("combined_video_path", ""),
+                audio_path=audio_file,
+                subtitle_path=subtitle_path,
+                output_file=final_video_path,
+                params=params,
+                video_timeline=video_timeline,
+            )
 
-        _progress += 50 / params.video_count / 2
-        sm.state.update_task(task_id, progress=_progress)
+            _progress += 50 / params.video_count / 2
+            sm.state.update_task(task_id, progress=_progress)
 
-        # Add hook video if enabled
-        if params.use_transitional_hook:
-            logger.info(f"\n\n## adding hook video to: {final_video_path}")
-            final_video_path = video.add_hook_video(
-                final_video_path=final_video_path,
-                video_aspect=params.video_aspect,
-                threads=params.n_threads,
-                specific_hook=params.specific_hook,
-            )
+            # Add hook video if enabled
+            if params.use_transitional_hook:
+                logger.info(f"\n\n## adding hook video to: {final_video_path}")
+                final_video_path = video.add_hook_video(
+                    final_video_path=final_video_path,
+                    video_aspect=params.video_aspect,
+                    threads=params.n_threads,
+                    specific_hook=params.specific_hook,
+                )
 
-        final_video_paths.append(final_video_path)
+            final_video_paths.append(final_video_path)
 
     # upload to youtube
     if params.upload_to_youtube and os.path.exists(final_video_path):
@@ -383,11 +618,35 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
     sm.state.update_task(
         task_id, state=const.TASK_STATE_PROCESSING, progress=20)
 
+    materials_key = checkpoint.key(
+        video_terms,
+        params.video_source,
+        params.video_aspect,
+        params.video_concat_mode,
+        params.video_clip_duration,
+        params.video_count,
+        utils.to_json(params.video_materials),
+    )
+    saved_materials = checkpoint.load(task_id, "materials", materials_key)
+
+    # material search only depends on the terms, download it while the audio and subtitle are generated
+    prefetch, prefetch_cancel_event = None, None
+    if (
+        params.video_source != "local"
+        and stop_at in ("materials", "video")
+        and not saved_materials
+    ):
+        prefetch, prefetch_cancel_event = prefetch_video_materials(
+            task_id, params, video_terms, video_script
+        )
+
     # 3. Generate audio
     audio_file, audio_duration, sub_maker = generate_audio(
         task_id, params, video_script
     )
     if not audio_file:
+        if prefetch_cancel_event:
+            prefetch_cancel_event.set()
         sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
         return
 
@@ -421,12 +680,26 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
         task_id, state=const.TASK_STATE_PROCESSING, progress=40)
 
     # 5. Get video materials
-    downloaded_videos = get_video_materials(
-        task_id, params, video_terms, audio_duration
-    )
+    if saved_materials and saved_materials["audio_duration"] >= audio_duration:
+        downloaded_videos = saved_materials["materials"]
+    elif prefetch:
+        downloaded_videos = collect_video_materials(
+            task_id, params, video_terms, audio_duration, prefetch
+        )
+    else:
+        downloaded_videos = get_video_materials(
+            task_id, params, video_terms, audio_duration
+        )
     if not downloaded_videos:
         sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
         return
+    checkpoint.save(
+        task_id,
+        "materials",
+        materials_key,
+        {"materials": downloaded_videos, "audio_duration": audio_duration},
+        files=downloaded_videos,
+    )
 
     if stop_at == "materials":
         sm.state.update_task(
@@ -0,0 +1,203 @@
+"""
+Serializable description of a rendered video.
+
+A timeline is an ordered list of segments (source file, in/out window, scale mode,
+transition and position on the output). It holds no decoder, so building one is
+cheap, and it can be written to disk and rendered by either backend.
+"""
+
+import json
+import random
+from typing import List
+
+from loguru import logger
+
+from app.models.schema import VideoConcatMode, VideoTransitionMode
+from app.services import probe
+
+# letterbox the source into the output frame
+SCALE_FIT = "fit"
+# scale the source up to cover the output frame and crop the overflow
+SCALE_FILL = "fill"
+
+SLIDE_SIDES = ["left", "right", "top", "bottom"]
+
+
+class Segment:
+    __slots__ = (
+        "source",
+        "start",
+        "end",
+        "scale_mode",
+        "transition",
+        "side",
+        "position",
+        "with_audio",
+    )
+
+    def __init__(
+        self,
+        source: str,
+        start: float = 0.0,
+        end: float = 0.0,
+        scale_mode: str = SCALE_FIT,
+        transition: str = None,
+        side: str = "left",
+        position: float = 0.0,
+        with_audio: bool = False,
+    ):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.scale_mode = scale_mode
+        self.transition = transition
+        self.side = side
+        self.position = position
+        self.with_audio = with_audio
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Segment":
+        return cls(**{k: data[k] for k in cls.__slots__ if k in data})
+
+    def __repr__(self):
+        return (
+            f"Segment({self.source}, {self.start:.2f}-{self.end:.2f}, "
+            f"at {self.position:.2f}, {self.transition})"
+        )
+
+
+class Timeline:
+    __slots__ = ("width", "height", "fps", "segments")
+
+    def __init__(self, width: int, height: int, fps: int = 30, segments=None):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.segments: List[Segment] = []
+        for segment in segments or []:
+            self.append(segment)
+
+    @property
+    def duration(self) -> float:
+        if not self.segments:
+            return 0.0
+        last = self.segments[-1]
+        return last.position + last.duration
+
+    def append(self, segment: Segment) -> Segment:
+        segment.position = self.duration
+        self.segments.append(segment)
+        return segment
+
+    def to_dict(self) -> dict:
+        return {
+            "width": self.width,
+            "height": self.height,
+            "fps": self.fps,
+            "segments": [s.to_dict() for s in self.segments],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Timeline":
+        return cls(
+            width=data["width"],
+            height=data["height"],
+            fps=data.get("fps", 30),
+            segments=[Segment.from_dict(s) for s in data.get("segments", [])],
+        )
+
+    def save(self, file: str):
+        with open(file, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, file: str) -> "Timeline":
+        with open(file, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+def get_video_duration(video_path: str) -> float:
+    return probe.probe(video_path)["duration"]
+
+
+def build(
+    video_paths: List[str],
+    audio_duration: float,
+    width: int,
+    height: int,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    video_transition_mode: VideoTransitionMode = None,
+    max_clip_duration: int = 5,
+    fps: int = 30,
+) -> Timeline:
+    """
+    Choose the sub-clips that make up the combined video, without decoding anything.
+    Shuffle transitions are resolved to a concrete transition per segment here, so a
+    saved timeline always renders the same way.
+    """
+    raw_clips = []
+    for video_path in video_paths:
+        clip_duration = get_video_duration(video_path)
+        start_time = 0
+
+        while start_time < clip_duration:
+            end_time = min(start_time + max_clip_duration, clip_duration)
+            raw_clips.append((video_path, start_time, end_time))
+            start_time = end_time
+            if video_concat_mode.value == VideoConcatMode.sequential.value:
+                break
+
+    # random video_paths order
+    if video_concat_mode.value == VideoConcatMode.random.value:
+        random.shuffle(raw_clips)
+
+    transition = VideoTransitionMode.none.value
+    if video_transition_mode:
+        transition = VideoTransitionMode(video_transition_mode).value
+    logger.info(f"Using transition mode: {video_transition_mode}")
+
+    timeline = Timeline(width=width, height=height, fps=fps)
+    # Add downloaded clips over and over until the duration of the audio (max_duration) has been reached
+    while raw_clips and timeline.duration < audio_duration:
+        for video_path, start_time, end_time in raw_clips:
+            remaining = audio_duration - timeline.duration
+            if remaining <= 0:
+                break
+            end_time = min(end_time, start_time + remaining, start_time + max_clip_duration)
+
+            clip_transition = transition
+            if clip_transition == VideoTransitionMode.shuffle.value:
+                clip_transition = random.choice(
+                    [
+                        VideoTransitionMode.fade_in.value,
+                        VideoTransitionMode.fade_out.value,
+                        VideoTransitionMode.slide_in.value,
+                        VideoTransitionMode.slide_out.value,
+                    ]
+                )
+
+            timeline.append(
+                Segment(
+                    source=video_path,
+                    start=start_time,
+                    end=end_time,
+                    transition=clip_transition,
+                    side=random.choice(SLIDE_SIDES),
+                )
+            )
+    return timeline
+
+
+def hook_segment(hook_file: str, max_duration: float) -> Segment:
+    """
+    The hook prefix keeps its own audio track.
+    """
+    duration = min(max_duration, get_video_duration(hook_file))
+    return Segment(source=hook_file, start=0.0, end=duration, with_audio=True)
@@ -0,0 +1,76 @@
+"""
+Queued whisper transcription shared by concurrent tasks.
+
+Tasks submit their audio to one queue, served by a worker per model of the
+subtitle pool. Each file is decoded to 16 kHz mono PCM once, in the submitting
+thread, and the samples are handed to faster-whisper's BatchedInferencePipeline,
+which transcribes the voiced chunks of a file `batch_size` at a time instead of
+one 30 second window after another. That is where CPU-only nodes gain most.
+"""
+
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List, Optional
+
+from faster_whisper import BatchedInferencePipeline, decode_audio
+from loguru import logger
+
+from app.config import config
+from app.services import subtitle
+
+SAMPLING_RATE = 16000
+
+_queue = queue.Queue()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+def batch_size() -> int:
+    return max(1, int(config.whisper.get("batch_size", 8)))
+
+
+def _work():
+    while True:
+        audio_file, audio, future = _queue.get()
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            with subtitle.acquire_model() as model:
+                if model is None:
+                    future.set_result(None)
+                    continue
+                pipeline = BatchedInferencePipeline(model=model)
+                logger.info(f"transcribing: {audio_file}, queued: {_queue.qsize()}")
+                future.set_result(
+                    subtitle.transcribe(pipeline, audio, batch_size=batch_size())
+                )
+        except Exception as e:
+            logger.error(f"failed to transcribe: {audio_file} => {str(e)}")
+            future.set_exception(e)
+
+
+def _ensure_workers():
+    with _workers_lock:
+        while len(_workers) < subtitle.pool_size():
+            worker = threading.Thread(
+                target=_work, name=f"transcription-{len(_workers)}", daemon=True
+            )
+            worker.start()
+            _workers.append(worker)
+
+
+def submit(audio_file: str) -> Future:
+    """
+    Queue an audio file, the future resolves to its subtitle items
+    (or None if no model could be loaded).
+    """
+    audio = decode_audio(audio_file, sampling_rate=SAMPLING_RATE)
+    future = Future()
+    _ensure_workers()
+    _queue.put((audio_file, audio, future))
+    return future
+
+
+def transcribe_file(audio_file: str) -> Optional[List[dict]]:
+    return submit(audio_file).result()
@@ -0,0 +1,131 @@
+"""
+Content-addressed cache of synthesized speech.
+
+Entries are keyed by hash(text, voice, rate, provider) and hold the MP3 audio plus a
+JSON file with the word boundaries, so a cache hit needs no network round-trip.
+azure_tts_v1 caches each chunk it synthesizes (the sentences of one paragraph, up to
+tts_chunk_size characters) and stitches the script from them, so scripts that only
+partially repeat (e.g. a shared outro paragraph) still reuse audio. azure_tts_v2
+synthesizes the text in one request and caches it as a whole.
+The cache is bounded by total size and evicts the least recently used entries first.
+"""
+
+import json
+import os
+import shutil
+import threading
+from typing import Optional, Tuple
+
+from loguru import logger
+
+from app.config import config
+from app.utils import utils
+
+_lock = threading.Lock()
+
+
+def cache_dir() -> str:
+    return utils.storage_dir("cache_tts", create=True)
+
+
+def max_size() -> int:
+    return int(config.app.get("tts_cache_max_mb", 512)) * 1024 * 1024
+
+
+def enabled() -> bool:
+    return max_size() > 0
+
+
+def cache_key(text: str, voice_name: str, voice_rate: float, provider: str) -> str:
+    return utils.md5(
+        json.dumps([text, voice_name, float(voice_rate or 1.0), provider], ensure_ascii=False)
+    )
+
+
+def _files(key: str) -> Tuple[str, str]:
+    base = os.path.join(cache_dir(), f"tts-{key}")
+    return f"{base}.mp3", f"{base}.json"
+
+
+def get(key: str) -> Optional[Tuple[str, dict]]:
+    """
+    Returns (audio file, metadata) of a cached entry, or None.
+    """
+    if not enabled():
+        return None
+    audio_file, meta_file = _files(key)
+    if not os.path.isfile(audio_file) or not os.path.isfile(meta_file):
+        return None
+    try:
+        with open(meta_file, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        # mtime is the lru clock
+        os.utime(audio_file)
+        os.utime(meta_file)
+    except Exception as e:
+        logger.warning(f"failed to read tts cache entry: {meta_file} => {str(e)}")
+        return None
+    return audio_file, meta
+
+
+def read_audio(audio_file: str) -> bytes:
+    with open(audio_file, "rb") as f:
+        return f.read()
+
+
+def put(key: str, audio, meta: dict):
+    """
+    Store an entry. `audio` is either the MP3 bytes or the path of an MP3 file.
+    """
+    if not enabled():
+        return
+    audio_file, meta_file = _files(key)
+    suffix = f"{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        if isinstance(audio, (bytes, bytearray)):
+            with open(f"{audio_file}.{suffix}", "wb") as f:
+                f.write(audio)
+        else:
+            shutil.copyfile(audio, f"{audio_file}.{suffix}")
+        with open(f"{meta_file}.{suffix}", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        # publish the audio before the metadata, get() requires both
+        os.replace(f"{audio_file}.{suffix}", audio_file)
+        os.replace(f"{meta_file}.{suffix}", meta_file)
+    except Exception as e:
+        logger.warning(f"failed to write tts cache entry: {audio_file} => {str(e)}")
+        for file in (f"{audio_file}.{suffix}", f"{meta_file}.{suffix}"):
+            if os.path.exists(file):
+                os.remove(file)
+        return
+    evict()
+
+
+def evict():
+    limit = max_size()
+    with _lock:
+        entries = {}
+        total = 0
+        for entry in os.scandir(cache_dir()):
+            if not entry.is_file() or not entry.name.startswith("tts-") or entry.name.endswith(".tmp"):
+                continue
+            stat = entry.stat()
+            key = os.path.splitext(entry.name)[0]
+            mtime, size, paths = entries.get(key, (0, 0, []))
+            entries[key] = (max(mtime, stat.st_mtime), size + stat.st_size, paths + [entry.path])
+            total += stat.st_size
+
+        if total <= limit:
+            return
+
+        for _, size, paths in sorted(entries.values()):
+            if total <= limit:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    logger.warning(f"failed to evict tts cache entry: {path} => {str(e)}")
+            total -= size
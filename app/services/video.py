@@ -1,23 +1,33 @@
+import bisect
 import glob
+import multiprocessing
 import os
 import random
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from typing import List
 
+import numpy as np
 from loguru import logger
 from moviepy import (
+    AudioArrayClip,
     AudioFileClip,
     ColorClip,
     CompositeAudioClip,
     CompositeVideoClip,
     ImageClip,
     TextClip,
+    VideoClip,
     VideoFileClip,
     afx,
     concatenate_videoclips,
 )
-from moviepy.video.tools.subtitles import SubtitlesClip
-from PIL import ImageFont
+from moviepy.config import FFMPEG_BINARY
+from PIL import Image, ImageFont
 
+from app.config import config
 from app.models import const
 from app.models.schema import (
     MaterialInfo,
@@ -26,6 +36,7 @@ from app.models.schema import (
     VideoParams,
     VideoTransitionMode,
 )
+from app.services import clip_cache, probe, subtitle_cues, timeline
 from app.services.utils import video_effects
 from app.utils import utils
 
@@ -46,128 +57,417 @@ def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
     return ""
 
 
-def combine_videos(
-    combined_video_path: str,
+def resize_clip(
+    clip, video_width: int, video_height: int, scale_mode: str = timeline.SCALE_FIT
+):
+    # Not all videos are same size, so we need to resize them
+    clip_w, clip_h = clip.size
+    if clip_w == video_width and clip_h == video_height:
+        return clip
+
+    logger.info(
+        f"resizing video to {video_width} x {video_height}, clip size: {clip_w} x {clip_h}"
+    )
+    clip_ratio = clip.w / clip.h
+    video_ratio = video_width / video_height
+
+    if clip_ratio == video_ratio:
+        # Resize proportionally
+        return clip.resized((video_width, video_height))
+
+    if scale_mode == timeline.SCALE_FILL:
+        # Cover the whole frame and crop the overflow
+        scale_factor = max(video_width / clip_w, video_height / clip_h)
+        clip_resized = clip.resized(
+            new_size=(round(clip_w * scale_factor), round(clip_h * scale_factor))
+        )
+        return clip_resized.cropped(
+            x_center=clip_resized.w / 2,
+            y_center=clip_resized.h / 2,
+            width=video_width,
+            height=video_height,
+        )
+
+    # Resize proportionally
+    if clip_ratio > video_ratio:
+        # Resize proportionally based on the target width
+        scale_factor = video_width / clip_w
+    else:
+        # Resize proportionally based on the target height
+        scale_factor = video_height / clip_h
+
+    new_width = int(clip_w * scale_factor)
+    new_height = int(clip_h * scale_factor)
+    clip_resized = clip.resized(new_size=(new_width, new_height))
+
+    background = ColorClip(size=(video_width, video_height), color=(0, 0, 0))
+    return CompositeVideoClip(
+        [
+            background.with_duration(clip.duration),
+            clip_resized.with_position("center"),
+        ]
+    )
+
+
+def apply_transition(clip, transition: str, side: str = "left"):
+    if transition == VideoTransitionMode.fade_in.value:
+        return video_effects.fadein_transition(clip, 1)
+    if transition == VideoTransitionMode.fade_out.value:
+        return video_effects.fadeout_transition(clip, 1)
+    if transition == VideoTransitionMode.slide_in.value:
+        return video_effects.slidein_transition(clip, 1, side)
+    if transition == VideoTransitionMode.slide_out.value:
+        return video_effects.slideout_transition(clip, 1, side)
+    return clip
+
+
+def _normalized_segment(
+    segment: timeline.Segment, video_width: int, video_height: int
+) -> timeline.Segment:
+    """
+    Point the segment at its cached normalized clip, if there is one.
+    """
+    if segment.with_audio:
+        return segment
+    normalized_file = clip_cache.lookup(
+        segment.source,
+        segment.start,
+        segment.end,
+        video_width,
+        video_height,
+        30,
+        segment.scale_mode,
+    )
+    if not normalized_file:
+        return segment
+    return timeline.Segment(
+        source=normalized_file,
+        start=0.0,
+        end=segment.duration,
+        scale_mode=segment.scale_mode,
+        transition=segment.transition,
+        side=segment.side,
+        position=segment.position,
+    )
+
+
+def open_segment(segment: timeline.Segment, video_width: int, video_height: int):
+    """
+    Open the decoder for a segment and apply fps, resize and transition.
+    Returns the source clip (close it to release the decoder) and the ready clip.
+    """
+    segment = _normalized_segment(segment, video_width, video_height)
+    source_clip = VideoFileClip(segment.source, audio=segment.with_audio)
+    clip = source_clip.subclipped(segment.start, segment.end).with_fps(30)
+    clip = resize_clip(clip, video_width, video_height, segment.scale_mode)
+    clip = apply_transition(clip, segment.transition, segment.side)
+    # composite onto an opaque frame so slide transitions reveal black, not a mask
+    return source_clip, CompositeVideoClip(
+        [clip], size=(video_width, video_height), bg_color=(0, 0, 0)
+    )
+
+
+class TimelineClip(VideoClip):
+    """
+    Video clip backed by a timeline, which opens each segment's decoder only while
+    the segment is on screen. Frames are requested in order when writing, so at most
+    one source file is open at any time.
+    """
+
+    def __init__(self, video_timeline: timeline.Timeline):
+        self.timeline = video_timeline
+        self._positions = [s.position for s in video_timeline.segments]
+        self._active_index = -1
+        self._active_source = None
+        self._active_clip = None
+        super().__init__(
+            frame_function=self._frame, duration=video_timeline.duration
+        )
+        self.fps = video_timeline.fps
+
+    def _frame(self, t):
+        index = max(0, bisect.bisect_right(self._positions, t) - 1)
+        segment = self.timeline.segments[index]
+        if index != self._active_index:
+            self.close()
+            self._active_source, self._active_clip = open_segment(
+                segment, self.timeline.width, self.timeline.height
+            )
+            self._active_index = index
+        local_t = min(t - segment.position, self._active_clip.duration)
+        return self._active_clip.get_frame(local_t)
+
+    def close(self):
+        if self._active_source:
+            self._active_source.close()
+        self._active_index = -1
+        self._active_source = None
+        self._active_clip = None
+
+
+def build_timeline(
     video_paths: List[str],
     audio_file: str,
     video_aspect: VideoAspect = VideoAspect.portrait,
     video_concat_mode: VideoConcatMode = VideoConcatMode.random,
     video_transition_mode: VideoTransitionMode = None,
     max_clip_duration: int = 5,
-    threads: int = 2,
-) -> str:
-    audio_clip = AudioFileClip(audio_file)
-    audio_duration = audio_clip.duration
+) -> timeline.Timeline:
+    audio_duration = probe.duration(audio_file)
     logger.info(f"max duration of audio: {audio_duration} seconds")
-    # Required duration of each clip
-    req_dur = audio_duration / len(video_paths)
-    req_dur = max_clip_duration
-    logger.info(f"each clip will be maximum {req_dur} seconds long")
-    output_dir = os.path.dirname(combined_video_path)
+    logger.info(f"each clip will be maximum {max_clip_duration} seconds long")
 
     aspect = VideoAspect(video_aspect)
     video_width, video_height = aspect.to_resolution()
+    return timeline.build(
+        video_paths=video_paths,
+        audio_duration=audio_duration,
+        width=video_width,
+        height=video_height,
+        video_concat_mode=video_concat_mode,
+        video_transition_mode=video_transition_mode,
+        max_clip_duration=max_clip_duration,
+    )
 
-    clips = []
-    video_duration = 0
-
-    raw_clips = []
-    for video_path in video_paths:
-        clip = VideoFileClip(video_path).without_audio()
-        clip_duration = clip.duration
-        start_time = 0
-
-        while start_time < clip_duration:
-            end_time = min(start_time + max_clip_duration, clip_duration)
-            split_clip = clip.subclipped(start_time, end_time)
-            raw_clips.append(split_clip)
-            # logger.info(f"splitting from {start_time:.2f} to {end_time:.2f}, clip duration {clip_duration:.2f}, split_clip duration {split_clip.duration:.2f}")
-            start_time = end_time
-            if video_concat_mode.value == VideoConcatMode.sequential.value:
-                break
-
-    # random video_paths order
-    if video_concat_mode.value == VideoConcatMode.random.value:
-        random.shuffle(raw_clips)
-
-    # Add downloaded clips over and over until the duration of the audio (max_duration) has been reached
-    while video_duration < audio_duration:
-        for clip in raw_clips:
-            # Check if clip is longer than the remaining audio
-            if (audio_duration - video_duration) < clip.duration:
-                clip = clip.subclipped(0, (audio_duration - video_duration))
-            # Only shorten clips if the calculated clip length (req_dur) is shorter than the actual clip to prevent still image
-            elif req_dur < clip.duration:
-                clip = clip.subclipped(0, req_dur)
-            clip = clip.with_fps(30)
-
-            # Not all videos are same size, so we need to resize them
-            clip_w, clip_h = clip.size
-            if clip_w != video_width or clip_h != video_height:
-                clip_ratio = clip.w / clip.h
-                video_ratio = video_width / video_height
-
-                if clip_ratio == video_ratio:
-                    # Resize proportionally
-                    clip = clip.resized((video_width, video_height))
-                else:
-                    # Resize proportionally
-                    if clip_ratio > video_ratio:
-                        # Resize proportionally based on the target width
-                        scale_factor = video_width / clip_w
-                    else:
-                        # Resize proportionally based on the target height
-                        scale_factor = video_height / clip_h
-
-                    new_width = int(clip_w * scale_factor)
-                    new_height = int(clip_h * scale_factor)
-                    clip_resized = clip.resized(new_size=(new_width, new_height))
-
-                    background = ColorClip(
-                        size=(video_width, video_height), color=(0, 0, 0)
-                    )
-                    clip = CompositeVideoClip(
-                        [
-                            background.with_duration(clip.duration),
-                            clip_resized.with_position("center"),
-                        ]
-                    )
-
-                logger.info(
-                    f"resizing video to {video_width} x {video_height}, clip size: {clip_w} x {clip_h}"
-                )
-
-            shuffle_side = random.choice(["left", "right", "top", "bottom"])
-            logger.info(f"Using transition mode: {video_transition_mode}")
-            if video_transition_mode.value == VideoTransitionMode.none.value:
-                clip = clip
-            elif video_transition_mode.value == VideoTransitionMode.fade_in.value:
-                clip = video_effects.fadein_transition(clip, 1)
-            elif video_transition_mode.value == VideoTransitionMode.fade_out.value:
-                clip = video_effects.fadeout_transition(clip, 1)
-            elif video_transition_mode.value == VideoTransitionMode.slide_in.value:
-                clip = video_effects.slidein_transition(clip, 1, shuffle_side)
-            elif video_transition_mode.value == VideoTransitionMode.slide_out.value:
-                clip = video_effects.slideout_transition(clip, 1, shuffle_side)
-            elif video_transition_mode.value == VideoTransitionMode.shuffle.value:
-                transition_funcs = [
-                    lambda c: video_effects.fadein_transition(c, 1),
-                    lambda c: video_effects.fadeout_transition(c, 1),
-                    lambda c: video_effects.slidein_transition(c, 1, shuffle_side),
-                    lambda c: video_effects.slideout_transition(c, 1, shuffle_side),
-                ]
-                shuffle_transition = random.choice(transition_funcs)
-                clip = shuffle_transition(clip)
-
-            if clip.duration > max_clip_duration:
-                clip = clip.subclipped(0, max_clip_duration)
-
-            clips.append(clip)
-            video_duration += clip.duration
-    clips = [CompositeVideoClip([clip]) for clip in clips]
-    video_clip = concatenate_videoclips(clips)
-    video_clip = video_clip.with_fps(30)
-    logger.info("writing")
+
+def _write_segment(
+    segment: timeline.Segment,
+    video_width: int,
+    video_height: int,
+    output_file: str,
+    threads: int = 1,
+):
+    source_clip, clip = open_segment(segment, video_width, video_height)
+    try:
+        clip.write_videofile(
+            filename=output_file,
+            codec="libx264",
+            audio=False,
+            threads=threads,
+            logger=None,
+            fps=30,
+        )
+    finally:
+        clip.close()
+        source_clip.close()
+
+
+def normalize_segment(
+    segment: timeline.Segment,
+    video_width: int,
+    video_height: int,
+    threads: int = 1,
+) -> str:
+    """
+    The trimmed and resized clip of a segment, without transition, from the clip cache.
+    """
+    plain_segment = timeline.Segment(
+        source=segment.source,
+        start=segment.start,
+        end=segment.end,
+        scale_mode=segment.scale_mode,
+    )
+    return clip_cache.get_or_create(
+        segment.source,
+        segment.start,
+        segment.end,
+        video_width,
+        video_height,
+        30,
+        segment.scale_mode,
+        lambda file: _write_segment(
+            plain_segment, video_width, video_height, file, threads
+        ),
+    )
+
+
+def normalize_segments(
+    segments: List[timeline.Segment],
+    video_width: int,
+    video_height: int,
+    threads: int = 2,
+    workers: int = 1,
+):
+    """
+    Fill the normalized clip cache for the segments, each clip window once, so the
+    timeline can be composed from the cached clips with the transitions applied on
+    the fly. With more than one worker the clips are encoded in parallel processes.
+    """
+    if not clip_cache.enabled():
+        return
+    windows = {}
+    for segment in segments:
+        windows.setdefault((segment.source, segment.start, segment.end), segment)
+    workers = min(workers, len(windows))
+    logger.info(f"normalizing {len(windows)} clips, workers: {max(workers, 1)}")
+    if workers <= 1:
+        for segment in windows.values():
+            normalize_segment(segment, video_width, video_height, threads)
+        return
+
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(
+                normalize_segment, segment, video_width, video_height, threads
+            )
+            for segment in windows.values()
+        ]
+        for future in futures:
+            future.result()
+
+
+def render_segment(
+    segment: timeline.Segment,
+    video_width: int,
+    video_height: int,
+    output_file: str,
+    threads: int = 1,
+) -> str:
+    """
+    Encode a single segment on its own. Runs in a worker process, so every segment
+    is written with identical encoder settings and the parts can be joined by stream copy.
+    The trimmed and resized clip comes from the normalized clip cache, only the
+    transition is applied per task.
+    """
+    if not clip_cache.enabled():
+        _write_segment(segment, video_width, video_height, output_file, threads)
+        return output_file
+
+    normalized_file = normalize_segment(segment, video_width, video_height, threads)
+    if segment.transition in (None, VideoTransitionMode.none.value):
+        shutil.copyfile(normalized_file, output_file)
+        return output_file
+
+    _write_segment(segment, video_width, video_height, output_file, threads)
+    return output_file
+
+
+def concat_videos(video_files: List[str], output_file: str) -> str:
+    """
+    Join videos that share codec parameters with the ffmpeg concat demuxer, without re-encoding.
+    """
+    list_file = f"{output_file}.concat.txt"
+    with open(list_file, "w", encoding="utf-8") as f:
+        for video_file in video_files:
+            escaped = os.path.abspath(video_file).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+    cmd = [
+        FFMPEG_BINARY,
+        "-y",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-f",
+        "concat",
+        "-safe",
+        "0",
+        "-i",
+        list_file,
+        "-c",
+        "copy",
+        "-movflags",
+        "+faststart",
+        output_file,
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    os.remove(list_file)
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"failed to concat videos: {result.stderr.decode('utf-8', errors='ignore')}"
+        )
+    return output_file
+
+
+def _render_segments(
+    video_timeline: timeline.Timeline, combined_video_path: str, workers: int
+) -> str:
+    segments_dir = f"{os.path.splitext(combined_video_path)[0]}-segments"
+    os.makedirs(segments_dir, exist_ok=True)
+    segment_files = [
+        os.path.join(segments_dir, f"segment-{idx + 1:04d}.mp4")
+        for idx in range(len(video_timeline.segments))
+    ]
+
+    if workers <= 1:
+        logger.info(f"rendering {len(video_timeline.segments)} segments")
+        for segment, segment_file in zip(video_timeline.segments, segment_files):
+            render_segment(
+                segment, video_timeline.width, video_timeline.height, segment_file
+            )
+        concat_videos(segment_files, combined_video_path)
+        shutil.rmtree(segments_dir, ignore_errors=True)
+        return combined_video_path
+
+    # split the cores between the workers, x264 still threads within a segment
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    logger.info(
+        f"rendering {len(video_timeline.segments)} segments with {workers} workers, {threads} threads each"
+    )
+    # spawn instead of fork, tasks run in threads of the api/webui process
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(
+                render_segment,
+                segment,
+                video_timeline.width,
+                video_timeline.height,
+                segment_file,
+                threads,
+            )
+            for segment, segment_file in zip(video_timeline.segments, segment_files)
+        ]
+        for future in futures:
+            future.result()
+
+    concat_videos(segment_files, combined_video_path)
+    shutil.rmtree(segments_dir, ignore_errors=True)
+    return combined_video_path
+
+
+def segment_workers(video_timeline: timeline.Timeline, workers: int = 0) -> int:
+    """
+    The processes to render the segments with, 0 means one per core.
+    """
+    return min(workers or os.cpu_count() or 1, len(video_timeline.segments))
+
+
+def prerender(video_timeline: timeline.Timeline, workers: int = 0) -> bool:
+    """
+    Whether the timeline is encoded to a combined video first, when its segments are
+    rendered in parallel without the clip cache. Otherwise generate_video composes
+    the timeline directly, from the cached normalized clips if the cache is enabled.
+    """
+    return segment_workers(video_timeline, workers) > 1 and not clip_cache.enabled()
+
+
+def render_timeline(
+    video_timeline: timeline.Timeline,
+    combined_video_path: str,
+    threads: int = 2,
+    workers: int = 0,
+) -> str:
+    """
+    Render the combined video. With more than one worker (0 means one per core),
+    segments are encoded in parallel processes and joined without re-encoding.
+    Segments are also rendered one by one when the normalized clip cache is enabled,
+    so cached clips can be reused.
+    """
+    output_dir = os.path.dirname(combined_video_path)
+    workers = segment_workers(video_timeline, workers)
+    if workers > 1 or clip_cache.enabled():
+        _render_segments(video_timeline, combined_video_path, workers)
+        logger.success("completed")
+        return combined_video_path
+
+    video_clip = TimelineClip(video_timeline)
+    logger.info(f"writing {len(video_timeline.segments)} segments")
     # https://github.com/harry0703/MoneyPrinterTurbo/issues/111#issuecomment-2032354030
     video_clip.write_videofile(
         filename=combined_video_path,
@@ -182,155 +482,330 @@ def combine_videos(
     return combined_video_path
 
 
-def wrap_text(text, max_width, font="Arial", fontsize=60):
-    # Create ImageFont
-    font = ImageFont.truetype(font, fontsize)
+def combine_videos(
+    combined_video_path: str,
+    video_paths: List[str],
+    audio_file: str,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    video_transition_mode: VideoTransitionMode = None,
+    max_clip_duration: int = 5,
+    threads: int = 2,
+    workers: int = 0,
+) -> str:
+    video_timeline = build_timeline(
+        video_paths=video_paths,
+        audio_file=audio_file,
+        video_aspect=video_aspect,
+        video_concat_mode=video_concat_mode,
+        video_transition_mode=video_transition_mode,
+        max_clip_duration=max_clip_duration,
+    )
+    return render_timeline(video_timeline, combined_video_path, threads, workers)
 
-    def get_text_size(inner_text):
-        inner_text = inner_text.strip()
-        left, top, right, bottom = font.getbbox(inner_text)
-        return right - left, bottom - top
 
-    width, height = get_text_size(text)
-    if width <= max_width:
-        return text, height
+@lru_cache(maxsize=32)
+def load_font(font: str, fontsize: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(font, fontsize)
 
-    # logger.warning(f"wrapping text, max_width: {max_width}, text_width: {width}, text: {text}")
 
-    processed = True
+# (font, fontsize) => {char: advance width}
+_glyph_widths = {}
 
-    _wrapped_lines_ = []
-    words = text.split(" ")
-    _txt_ = ""
-    for word in words:
-        _before = _txt_
-        _txt_ += f"{word} "
-        _width, _height = get_text_size(_txt_)
-        if _width <= max_width:
-            continue
-        else:
-            if _txt_.strip() == word.strip():
-                processed = False
-                break
-            _wrapped_lines_.append(_before)
-            _txt_ = f"{word} "
-    _wrapped_lines_.append(_txt_)
-    if processed:
-        _wrapped_lines_ = [line.strip() for line in _wrapped_lines_]
-        result = "\n".join(_wrapped_lines_).strip()
-        height = len(_wrapped_lines_) * height
-        # logger.warning(f"wrapped text: {result}")
-        return result, height
-
-    _wrapped_lines_ = []
-    chars = list(text)
-    _txt_ = ""
-    for word in chars:
-        _txt_ += word
-        _width, _height = get_text_size(_txt_)
-        if _width <= max_width:
+
+def _text_width(font: str, fontsize: int, text: str) -> float:
+    """
+    Width of a single line as the sum of the glyph advances, each measured once per font.
+    """
+    widths = _glyph_widths.setdefault((font, fontsize), {})
+    total = 0.0
+    for char in text:
+        width = widths.get(char)
+        if width is None:
+            width = load_font(font, fontsize).getlength(char)
+            widths[char] = width
+        total += width
+    return total
+
+
+def _wrap_words(text: str, max_width, font: str, fontsize: int):
+    """
+    Greedy line breaking at spaces. Returns None if a single word is wider than a line.
+    """
+    space_width = _text_width(font, fontsize, " ")
+    lines = []
+    line_words = []
+    line_width = 0.0
+    for word in text.split(" "):
+        if not word:
             continue
-        else:
-            _wrapped_lines_.append(_txt_)
-            _txt_ = ""
-    _wrapped_lines_.append(_txt_)
-    result = "\n".join(_wrapped_lines_).strip()
-    height = len(_wrapped_lines_) * height
-    # logger.warning(f"wrapped text: {result}")
-    return result, height
+        word_width = _text_width(font, fontsize, word)
+        if word_width > max_width:
+            return None
+        width = line_width + space_width + word_width if line_words else word_width
+        if width > max_width:
+            lines.append(" ".join(line_words))
+            line_words, width = [], word_width
+        line_words.append(word)
+        line_width = width
+    lines.append(" ".join(line_words))
+    return lines
 
 
-def generate_video(
-    video_path: str,
-    audio_path: str,
-    subtitle_path: str,
-    output_file: str,
-    params: VideoParams,
+def _wrap_chars(text: str, max_width, font: str, fontsize: int):
+    """
+    Line breaking between any two characters, for scripts without spaces (CJK).
+    The end of each line is found by binary search over the cumulative glyph widths.
+    """
+    offsets = [0.0]
+    for char in text:
+        offsets.append(offsets[-1] + _text_width(font, fontsize, char))
+
+    lines = []
+    start = 0
+    while start < len(text):
+        end = bisect.bisect_right(offsets, offsets[start] + max_width) - 1
+        # always make progress, even if one glyph is wider than the line
+        end = max(end, start + 1)
+        lines.append(text[start:end])
+        start = end
+    return lines
+
+
+def wrap_text(text, max_width, font="Arial", fontsize=60):
+    text = text.strip()
+    left, top, right, bottom = load_font(font, fontsize).getbbox(text)
+    height = bottom - top
+
+    if _text_width(font, fontsize, text) <= max_width:
+        return text, height
+
+    lines = _wrap_words(text, max_width, font, fontsize)
+    if lines is None:
+        lines = _wrap_chars(text, max_width, font, fontsize)
+    lines = [line.strip() for line in lines]
+    return "\n".join(lines).strip(), len(lines) * height
+
+
+def get_font_path(params: VideoParams) -> str:
+    if not params.font_name:
+        params.font_name = "STHeitiMedium.ttc"
+    font_path = os.path.join(utils.font_dir(), params.font_name)
+    if os.name == "nt":
+        font_path = font_path.replace("\\", "/")
+    return font_path
+
+
+def _render_subtitle_sprite(
+    text: str,
+    font_path: str,
+    font_size: int,
+    color: str,
+    bg_color,
+    stroke_color: str,
+    stroke_width: int,
+    max_width: float,
 ):
-    aspect = VideoAspect(params.video_aspect)
-    video_width, video_height = aspect.to_resolution()
+    """
+    Rasterize a subtitle line. Returns the RGB pixels and the alpha (0-255) planes.
+    """
+    wrapped_txt, _ = wrap_text(text, max_width=max_width, font=font_path, fontsize=font_size)
+    clip = TextClip(
+        text=wrapped_txt,
+        font=font_path,
+        font_size=font_size,
+        color=color,
+        bg_color=bg_color,
+        stroke_color=stroke_color,
+        stroke_width=stroke_width,
+    )
+    rgb = clip.get_frame(0).astype("uint8")
+    alpha = np.full(rgb.shape[:2], 255, dtype="uint8")
+    if clip.mask is not None:
+        alpha = np.rint(clip.mask.get_frame(0) * 255).astype("uint8")
+    clip.close()
+    rgb.flags.writeable = False
+    alpha.flags.writeable = False
+    return rgb, alpha
 
-    logger.info(f"start, video size: {video_width} x {video_height}")
-    logger.info(f"  ① video: {video_path}")
-    logger.info(f"  ② audio: {audio_path}")
-    logger.info(f"  ③ subtitle: {subtitle_path}")
-    logger.info(f"  ④ output: {output_file}")
 
-    # https://github.com/harry0703/MoneyPrinterTurbo/issues/217
-    # PermissionError: [WinError 32] The process cannot access the file because it is being used by another process: 'final-1.mp4.tempTEMP_MPY_wvf_snd.mp3'
-    # write into the same directory as the output file
-    output_dir = os.path.dirname(output_file)
+class SubtitleSprite:
+    __slots__ = ("start", "end", "x", "y", "rgb", "alpha")
 
-    font_path = ""
-    if params.subtitle_enabled:
-        if not params.font_name:
-            params.font_name = "STHeitiMedium.ttc"
-        font_path = os.path.join(utils.font_dir(), params.font_name)
-        if os.name == "nt":
-            font_path = font_path.replace("\\", "/")
-
-        logger.info(f"using font: {font_path}")
-
-    def create_text_clip(subtitle_item):
-        params.font_size = int(params.font_size)
-        params.stroke_width = int(params.stroke_width)
-        phrase = subtitle_item[1]
-        max_width = video_width * 0.9
-        wrapped_txt, txt_height = wrap_text(
-            phrase, max_width=max_width, font=font_path, fontsize=params.font_size
-        )
-        _clip = TextClip(
-            text=wrapped_txt,
-            font=font_path,
-            font_size=params.font_size,
-            color=params.text_fore_color,
-            bg_color=params.text_background_color,
-            stroke_color=params.stroke_color,
-            stroke_width=params.stroke_width,
-        )
-        duration = subtitle_item[0][1] - subtitle_item[0][0]
-        _clip = _clip.with_start(subtitle_item[0][0])
-        _clip = _clip.with_end(subtitle_item[0][1])
-        _clip = _clip.with_duration(duration)
-        if params.subtitle_position == "bottom":
-            _clip = _clip.with_position(("center", video_height * 0.85 - _clip.h))
-        elif params.subtitle_position == "top":
-            _clip = _clip.with_position(("center", video_height * 0.05))
-        elif params.subtitle_position == "custom":
-            # Ensure the subtitle is fully within the screen bounds
-            margin = 10  # Additional margin, in pixels
-            max_y = video_height - _clip.h - margin
-            min_y = margin
-            custom_y = (video_height - _clip.h) * (params.custom_position / 100)
-            custom_y = max(
-                min_y, min(custom_y, max_y)
-            )  # Constrain the y value within the valid range
-            _clip = _clip.with_position(("center", custom_y))
-        else:  # center
-            _clip = _clip.with_position(("center", "center"))
-        return _clip
-
-    video_clip = VideoFileClip(video_path)
-    audio_clip = AudioFileClip(audio_path).with_effects(
-        [afx.MultiplyVolume(params.voice_volume)]
+    def __init__(self, start, end, x, y, rgb, alpha):
+        self.start = start
+        self.end = end
+        self.x = x
+        self.y = y
+        self.rgb = rgb
+        self.alpha = alpha
+
+
+def create_subtitle_sprite(
+    subtitle_item,
+    params: VideoParams,
+    font_path: str,
+    video_width: int,
+    video_height: int,
+    cache: dict = None,
+) -> SubtitleSprite:
+    """
+    `cache` maps rasterize arguments to pixels, so repeated lines of one subtitle
+    file are drawn once; it lives as long as the caller keeps it.
+    """
+    params.font_size = int(params.font_size)
+    params.stroke_width = int(params.stroke_width)
+    (start_time, end_time), phrase = subtitle_item
+    key = (
+        phrase,
+        font_path,
+        params.font_size,
+        params.text_fore_color,
+        params.text_background_color,
+        params.stroke_color,
+        params.stroke_width,
+        video_width * 0.9,
     )
+    if cache is not None and key in cache:
+        rgb, alpha = cache[key]
+    else:
+        rgb, alpha = _render_subtitle_sprite(*key)
+        if cache is not None:
+            cache[key] = rgb, alpha
+    h, w = alpha.shape
+    x = (video_width - w) / 2
+    if params.subtitle_position == "bottom":
+        y = video_height * 0.85 - h
+    elif params.subtitle_position == "top":
+        y = video_height * 0.05
+    elif params.subtitle_position == "custom":
+        # Ensure the subtitle is fully within the screen bounds
+        margin = 10  # Additional margin, in pixels
+        max_y = video_height - h - margin
+        min_y = margin
+        custom_y = (video_height - h) * (params.custom_position / 100)
+        y = max(min_y, min(custom_y, max_y))  # Constrain the y value within the valid range
+    else:  # center
+        y = (video_height - h) / 2
+    return SubtitleSprite(start_time, end_time, int(x), int(y), rgb, alpha)
+
+
+def create_subtitle_sprites(
+    subtitle_path: str, params: VideoParams, video_width: int, video_height: int
+) -> List[SubtitleSprite]:
+    cues = subtitle_cues.load(subtitle_path)
+    if not cues:
+        return []
+
+    font_path = get_font_path(params)
+    logger.info(f"using font: {font_path}")
+    # scoped to this subtitle file, the sprites are dropped with the render
+    cache = {}
+    sprites = [
+        create_subtitle_sprite(item, params, font_path, video_width, video_height, cache)
+        for item in cues.items()
+    ]
+    return [sprite for sprite in sprites if sprite.end > sprite.start]
 
-    def make_textclip(text):
-        return TextClip(
-            text=text,
-            font=font_path,
-            font_size=params.font_size,
+
+class SubtitleOverlayClip(VideoClip):
+    """
+    Draws the subtitle sprites over a clip in a single pass. Each frame only blends
+    the cues active at that time, instead of compositing one layer per subtitle line.
+    """
+
+    def __init__(self, clip: VideoClip, sprites: List[SubtitleSprite]):
+        self.clip = clip
+        self.sprites = sorted(sprites, key=lambda sprite: sprite.start)
+        self._starts = [sprite.start for sprite in self.sprites]
+        self._max_duration = max(
+            (sprite.end - sprite.start for sprite in self.sprites), default=0
         )
+        super().__init__(frame_function=self._frame, duration=clip.duration)
+        self.fps = clip.fps
+
+    def _active_sprites(self, t):
+        index = bisect.bisect_right(self._starts, t) - 1
+        active = []
+        # an active cue started less than the longest cue duration ago
+        while index >= 0 and self._starts[index] > t - self._max_duration:
+            sprite = self.sprites[index]
+            if sprite.end > t:
+                active.append(sprite)
+            index -= 1
+        return reversed(active)
+
+    def _frame(self, t):
+        frame = self.clip.get_frame(t)
+        copied = False
+        frame_h, frame_w = frame.shape[:2]
+        for sprite in self._active_sprites(t):
+            h, w = sprite.alpha.shape
+            x0, y0 = max(0, sprite.x), max(0, sprite.y)
+            x1, y1 = min(frame_w, sprite.x + w), min(frame_h, sprite.y + h)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            if not copied:
+                frame = frame.copy()
+                copied = True
+            sx, sy = x0 - sprite.x, y0 - sprite.y
+            alpha = sprite.alpha[sy : sy + y1 - y0, sx : sx + x1 - x0, None] / np.float32(255)
+            rgb = sprite.rgb[sy : sy + y1 - y0, sx : sx + x1 - x0]
+            region = frame[y0:y1, x0:x1]
+            frame[y0:y1, x0:x1] = (region * (1 - alpha) + rgb * alpha).astype("uint8")
+        return frame
+
+    def close(self):
+        self.clip.close()
+
+
+# "sprite": subtitles are composited in python, "ass": burned in by ffmpeg/libass while encoding
+SUBTITLE_MODE_SPRITE = "sprite"
+SUBTITLE_MODE_ASS = "ass"
 
-    if subtitle_path and os.path.exists(subtitle_path):
-        sub = SubtitlesClip(
-            subtitles=subtitle_path, encoding="utf-8", make_textclip=make_textclip
+
+def subtitle_render_mode() -> str:
+    mode = config.app.get("subtitle_render_mode", SUBTITLE_MODE_SPRITE).strip().lower()
+    return SUBTITLE_MODE_ASS if mode == SUBTITLE_MODE_ASS else SUBTITLE_MODE_SPRITE
+
+
+def prepare_subtitles(
+    subtitle_path: str, params: VideoParams, video_width: int, video_height: int
+):
+    """
+    Returns the subtitle sprites to composite, or the ASS file to burn in, depending
+    on subtitle_render_mode.
+    """
+    if not params.subtitle_enabled:
+        return [], ""
+    if subtitle_render_mode() == SUBTITLE_MODE_ASS:
+        from app.services import subtitle_ass
+
+        ass_file = subtitle_ass.srt_to_ass(
+            subtitle_path, params, video_width, video_height
         )
-        text_clips = []
-        for item in sub.subtitles:
-            clip = create_text_clip(subtitle_item=item)
-            text_clips.append(clip)
-        video_clip = CompositeVideoClip([video_clip, *text_clips])
+        return [], ass_file
+    return create_subtitle_sprites(subtitle_path, params, video_width, video_height), ""
+
+
+def _write_final_video(
+    video_clip: VideoClip,
+    audio_clip,
+    subtitle_sprites: List[SubtitleSprite],
+    params: VideoParams,
+    output_file: str,
+    ass_file: str = "",
+):
+    """
+    Overlay the subtitles, mix the bgm under the voice and encode.
+    """
+    # https://github.com/harry0703/MoneyPrinterTurbo/issues/217
+    # PermissionError: [WinError 32] The process cannot access the file because it is being used by another process: 'final-1.mp4.tempTEMP_MPY_wvf_snd.mp3'
+    # write into the same directory as the output file
+    output_dir = os.path.dirname(output_file)
+
+    if subtitle_sprites:
+        video_clip = SubtitleOverlayClip(video_clip, subtitle_sprites)
 
     bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
     if bgm_file:
@@ -346,6 +821,12 @@ def generate_video(
         except Exception as e:
             logger.error(f"failed to add bgm: {str(e)}")
 
+    ffmpeg_params = None
+    if ass_file:
+        from app.services import subtitle_ass
+
+        ffmpeg_params = ["-vf", subtitle_ass.burn_filter(ass_file)]
+
     video_clip = video_clip.with_audio(audio_clip)
     video_clip.write_videofile(
         output_file,
@@ -354,25 +835,149 @@ def generate_video(
         threads=params.n_threads or 2,
         logger=None,
         fps=30,
+        ffmpeg_params=ffmpeg_params,
     )
     video_clip.close()
     del video_clip
+
+
+def generate_video(
+    video_path: str,
+    audio_path: str,
+    subtitle_path: str,
+    output_file: str,
+    params: VideoParams,
+    video_timeline: timeline.Timeline = None,
+):
+    """
+    Burn subtitles and mix bgm into the combined video. When a timeline is given it
+    is composed directly instead, so no intermediate combined video is encoded.
+    """
+    aspect = VideoAspect(params.video_aspect)
+    video_width, video_height = aspect.to_resolution()
+
+    logger.info(f"start, video size: {video_width} x {video_height}")
+    if video_timeline:
+        logger.info(f"  ① video: {len(video_timeline.segments)} timeline segments")
+    else:
+        logger.info(f"  ① video: {video_path}")
+    logger.info(f"  ② audio: {audio_path}")
+    logger.info(f"  ③ subtitle: {subtitle_path}")
+    logger.info(f"  ④ output: {output_file}")
+
+    if video_timeline:
+        video_clip = TimelineClip(video_timeline)
+    else:
+        video_clip = VideoFileClip(video_path)
+    audio_clip = AudioFileClip(audio_path).with_effects(
+        [afx.MultiplyVolume(params.voice_volume)]
+    )
+
+    subtitle_sprites, ass_file = prepare_subtitles(
+        subtitle_path, params, video_width, video_height
+    )
+    _write_final_video(
+        video_clip, audio_clip, subtitle_sprites, params, output_file, ass_file
+    )
     logger.success("completed")
 
 
+def generate_video_variants(
+    video_paths: List[str],
+    audio_path: str,
+    subtitle_path: str,
+    output_files: List[str],
+    params: VideoParams,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    workers: int = 0,
+) -> List[str]:
+    """
+    Render several variants of the same task, each with its own shuffled timeline.
+    The voice track is decoded, the subtitles rasterized and the source clips
+    normalized once and shared, so each variant only composes and encodes.
+    Variants are written concurrently, `workers` at a time (0 means one per variant).
+    """
+    aspect = VideoAspect(params.video_aspect)
+    video_width, video_height = aspect.to_resolution()
+    logger.info(
+        f"start, rendering {len(output_files)} variants, video size: {video_width} x {video_height}"
+    )
+
+    # 1. decode the voice once
+    audio_file_clip = AudioFileClip(audio_path)
+    audio_duration = audio_file_clip.duration
+    audio_fps = audio_file_clip.fps
+    # AudioArrayClip leaves `end` unset, CompositeAudioClip needs it to mix the bgm
+    voice_clip = (
+        AudioArrayClip(audio_file_clip.to_soundarray(fps=audio_fps), fps=audio_fps)
+        .with_duration(audio_duration)
+        .with_effects([afx.MultiplyVolume(params.voice_volume)])
+    )
+    audio_file_clip.close()
+
+    # 2. rasterize the subtitles once
+    subtitle_sprites, ass_file = prepare_subtitles(
+        subtitle_path, params, video_width, video_height
+    )
+
+    # 3. one timeline per variant, sharing the normalized clips
+    timelines = [
+        timeline.build(
+            video_paths=video_paths,
+            audio_duration=audio_duration,
+            width=video_width,
+            height=video_height,
+            video_concat_mode=video_concat_mode,
+            video_transition_mode=params.video_transition_mode,
+            max_clip_duration=params.video_clip_duration,
+        )
+        for _ in output_files
+    ]
+    normalize_segments(
+        [segment for video_timeline in timelines for segment in video_timeline.segments],
+        video_width,
+        video_height,
+        params.n_threads or 2,
+    )
+
+    # 4. compose and encode the variants
+    def _render(video_timeline: timeline.Timeline, output_file: str) -> str:
+        logger.info(f"rendering variant: {output_file}")
+        video_clip = TimelineClip(video_timeline)
+        _write_final_video(
+            video_clip, voice_clip, subtitle_sprites, params, output_file, ass_file
+        )
+        return output_file
+
+    workers = max(1, workers or len(output_files))
+    final_files = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_render, video_timeline, output_file)
+            for video_timeline, output_file in zip(timelines, output_files)
+        ]
+        for future in futures:
+            try:
+                final_files.append(future.result())
+            except Exception as e:
+                logger.error(f"failed to render variant: {str(e)}")
+    logger.success(f"completed, rendered {len(final_files)} variants")
+    return final_files
+
+
 def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
     for material in materials:
         if not material.url:
             continue
 
         ext = utils.parse_extension(material.url)
-        try:
-            clip = VideoFileClip(material.url)
-        except Exception:
-            clip = ImageClip(material.url)
+        if ext in const.FILE_TYPE_IMAGES:
+            with Image.open(material.url) as image:
+                width, height = image.size
+        else:
+            info = probe.probe(material.url)
+            width, height = info["width"], info["height"]
 
-        width = clip.size[0]
-        height = clip.size[1]
         if width < 480 or height < 480:
             logger.warning(f"video is too small, width: {width}, height: {height}")
             continue
@@ -408,24 +1013,12 @@ def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
     return materials
 
 
-def add_hook_video(final_video_path: str, video_aspect: VideoAspect = VideoAspect.portrait, max_clip_duration: int = 10, threads: int = 2, specific_hook: str = None) -> str:
-    """Generate a hook video and concatenate it with the final video.
-    
-    Args:
-        final_video_path: Path to the final video
-        video_paths: List of video paths to choose from for the hook
-        video_aspect: Video aspect ratio
-        max_clip_duration: Maximum duration of the hook clip
-        threads: Number of threads to use for video processing
-        
-    Returns:
-        str: Path to the new video with hook
-    """
+def get_hook_file(specific_hook: str = None) -> str:
     # Get hook videos from storage/transitional_hooks directory
     hooks_dir = utils.storage_dir("transitional_hooks")
     if not os.path.exists(hooks_dir):
         logger.warning(f"Transitional hooks directory not found: {hooks_dir}")
-        return final_video_path
+        return ""
         
     # Get all video files from hooks directory
     hook_files = []
@@ -434,43 +1027,34 @@ def add_hook_video(final_video_path: str, video_aspect: VideoAspect = VideoAspec
         
     if not hook_files:
         logger.warning(f"No hook videos found in: {hooks_dir}")
-        return final_video_path
+        return ""
         
     # Use specific hook if provided, otherwise choose random
-    hook_video_path = specific_hook if specific_hook and specific_hook in hook_files else random.choice(hook_files)
-    hook_clip = VideoFileClip(hook_video_path)
-    # hook_clip = VideoFileClip(hook_video_path).without_audio()
-    
-    # Limit hook duration
-    if hook_clip.duration > max_clip_duration:
-        hook_clip = hook_clip.subclipped(0, max_clip_duration)
+    return specific_hook if specific_hook and specific_hook in hook_files else random.choice(hook_files)
+
+
+def add_hook_video(final_video_path: str, video_aspect: VideoAspect = VideoAspect.portrait, max_clip_duration: int = 10, threads: int = 2, specific_hook: str = None) -> str:
+    """Generate a hook video and concatenate it with the final video.
     
-    # Resize hook video if needed
+    Args:
+        final_video_path: Path to the final video
+        video_paths: List of video paths to choose from for the hook
+        video_aspect: Video aspect ratio
+        max_clip_duration: Maximum duration of the hook clip
+        threads: Number of threads to use for video processing
+        
+    Returns:
+        str: Path to the new video with hook
+    """
+    hook_video_path = get_hook_file(specific_hook)
+    if not hook_video_path:
+        return final_video_path
+
+    # Limit hook duration and resize hook video if needed
     aspect = VideoAspect(video_aspect)
     video_width, video_height = aspect.to_resolution()
-    
-    clip_w, clip_h = hook_clip.size
-    if clip_w != video_width or clip_h != video_height:
-        clip_ratio = hook_clip.w / hook_clip.h
-        video_ratio = video_width / video_height
-        
-        if clip_ratio == video_ratio:
-            hook_clip = hook_clip.resized((video_width, video_height))
-        else:
-            if clip_ratio > video_ratio:
-                scale_factor = video_width / clip_w
-            else:
-                scale_factor = video_height / clip_h
-            
-            new_width = int(clip_w * scale_factor)
-            new_height = int(clip_h * scale_factor)
-            clip_resized = hook_clip.resized(new_size=(new_width, new_height))
-            
-            background = ColorClip(size=(video_width, video_height), color=(0, 0, 0))
-            hook_clip = CompositeVideoClip([
-                background.with_duration(clip_resized.duration),
-                clip_resized.with_position("center"),
-            ])
+    segment = timeline.hook_segment(hook_video_path, max_clip_duration)
+    hook_source, hook_clip = open_segment(segment, video_width, video_height)
     
     # Add fade out transition to hook
     # hook_clip = video_effects.fadeout_transition(hook_clip, 1)
@@ -496,7 +1080,7 @@ def add_hook_video(final_video_path: str, video_aspect: VideoAspect = VideoAspec
     )
     
     # Clean up
-    hook_clip.close()
+    hook_source.close()
     final_clip.close()
     combined.close()
     
@@ -1,17 +1,18 @@
 import asyncio
+import difflib
 import os
 import re
+import shutil
 from datetime import datetime
-from typing import Union
+from typing import List, Optional, Union
 from xml.sax.saxutils import unescape
 
 import edge_tts
 from edge_tts import SubMaker, submaker
-from edge_tts.submaker import mktimestamp
 from loguru import logger
-from moviepy.video.tools import subtitles
 
 from app.config import config
+from app.services import probe, subtitle_cues, tts_cache
 from app.utils import utils
 
 
@@ -1065,39 +1066,111 @@ def convert_rate_to_percent(rate: float) -> str:
         return f"{percent}%"
 
 
+# sentence ends, the punctuation stays with its sentence
+_sentence_end_pattern = re.compile(r"(?<=[.!?;。！？；…\n])")
+
+
+def split_tts_chunks(text: str, max_chars: int = 800) -> List[str]:
+    """
+    Split the text at sentence boundaries into chunks of at most max_chars
+    (a single longer sentence stays whole), so they can be synthesized concurrently.
+    Chunks never span paragraphs, so a repeated paragraph is a tts cache hit.
+    """
+    chunks = []
+    for paragraph in text.split("\n"):
+        chunk = ""
+        for sentence in _sentence_end_pattern.split(paragraph):
+            if not sentence.strip():
+                continue
+            if chunk and len(chunk) + len(sentence) > max_chars:
+                chunks.append(chunk.strip())
+                chunk = ""
+            chunk += sentence
+        if chunk.strip():
+            chunks.append(chunk.strip())
+    return chunks
+
+
 def azure_tts_v1(
     text: str, voice_name: str, voice_rate: float, voice_file: str
 ) -> Union[SubMaker, None]:
+    """
+    Synthesize the text with edge-tts. Long scripts are split at sentence boundaries
+    and the chunks are synthesized concurrently, or read from the tts cache, then the
+    audio is stitched and the word boundaries shifted into one SubMaker.
+    A failed chunk is retried on its own.
+    """
     voice_name = parse_voice_name(voice_name)
     text = text.strip()
     rate_str = convert_rate_to_percent(voice_rate)
-    for i in range(3):
-        try:
-            logger.info(f"start, voice name: {voice_name}, try: {i + 1}")
+    chunks = split_tts_chunks(text, config.app.get("tts_chunk_size", 800))
+    concurrency = max(1, config.app.get("tts_concurrency", 4))
+    logger.info(
+        f"start, voice name: {voice_name}, chunks: {len(chunks)}, concurrency: {concurrency}"
+    )
+
+    async def _synthesize(chunk: str):
+        communicate = edge_tts.Communicate(chunk, voice_name, rate=rate_str)
+        audio = bytearray()
+        boundaries = []
+        async for item in communicate.stream():
+            if item["type"] == "audio":
+                audio += item["data"]
+            elif item["type"] == "WordBoundary":
+                boundaries.append((item["offset"], item["duration"], item["text"]))
+        if not audio or not boundaries:
+            raise ValueError("no audio or word boundaries received")
+        return bytes(audio), boundaries
+
+    async def _synthesize_with_retry(index: int, chunk: str, semaphore):
+        key = tts_cache.cache_key(chunk, voice_name, voice_rate, "edge")
+        cached = tts_cache.get(key)
+        if cached:
+            audio_file, meta = cached
+            return tts_cache.read_audio(audio_file), meta["boundaries"]
+
+        async with semaphore:
+            for i in range(3):
+                try:
+                    audio, boundaries = await _synthesize(chunk)
+                    tts_cache.put(key, audio, {"boundaries": boundaries})
+                    return audio, boundaries
+                except Exception as e:
+                    logger.warning(
+                        f"chunk {index + 1}/{len(chunks)} failed, try: {i + 1}, error: {str(e)}"
+                    )
+        return None
 
-            async def _do() -> SubMaker:
-                communicate = edge_tts.Communicate(text, voice_name, rate=rate_str)
-                sub_maker = edge_tts.SubMaker()
-                with open(voice_file, "wb") as file:
-                    async for chunk in communicate.stream():
-                        if chunk["type"] == "audio":
-                            file.write(chunk["data"])
-                        elif chunk["type"] == "WordBoundary":
-                            sub_maker.create_sub(
-                                (chunk["offset"], chunk["duration"]), chunk["text"]
-                            )
-                return sub_maker
+    async def _do():
+        semaphore = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(
+            *[
+                _synthesize_with_retry(index, chunk, semaphore)
+                for index, chunk in enumerate(chunks)
+            ]
+        )
 
-            sub_maker = asyncio.run(_do())
-            if not sub_maker or not sub_maker.subs:
-                logger.warning("failed, sub_maker is None or sub_maker.subs is None")
-                continue
+    try:
+        results = asyncio.run(_do())
+    except Exception as e:
+        logger.error(f"failed, error: {str(e)}")
+        return None
+    if not results or any(result is None for result in results):
+        logger.error("failed, some chunks could not be synthesized")
+        return None
 
-            logger.info(f"completed, output file: {voice_file}")
-            return sub_maker
-        except Exception as e:
-            logger.error(f"failed, error: {str(e)}")
-    return None
+    sub_maker = edge_tts.SubMaker()
+    # offsets are in 100ns ticks, relative to the start of each chunk
+    offset = 0
+    with open(voice_file, "wb") as file:
+        for audio, boundaries in results:
+            for start, duration, word in boundaries:
+                sub_maker.create_sub((start + offset, duration), word)
+            file.write(audio)
+            offset += int(probe.mp3_duration(audio) * 10000000)
+
+    logger.info(f"completed, output file: {voice_file}")
+    return sub_maker
 
 
 def azure_tts_v2(text: str, voice_name: str, voice_file: str) -> Union[SubMaker, None]:
@@ -1107,6 +1180,18 @@ def azure_tts_v2(text: str, voice_name: str, voice_file: str) -> Union[SubMaker,
         raise ValueError(f"invalid voice name: {voice_name}")
     text = text.strip()
 
+    # azure v2 has no rate, the whole text is one entry
+    key = tts_cache.cache_key(text, voice_name, 1.0, "azure-v2")
+    cached = tts_cache.get(key)
+    if cached:
+        audio_file, meta = cached
+        logger.info(f"tts cache hit, voice name: {voice_name}")
+        shutil.copyfile(audio_file, voice_file)
+        sub_maker = SubMaker()
+        sub_maker.offset = [tuple(offset) for offset in meta["offset"]]
+        sub_maker.subs = meta["subs"]
+        return sub_maker
+
     def _format_duration_to_offset(duration) -> int:
         if isinstance(duration, str):
             time_obj = datetime.strptime(duration, "%H:%M:%S.%f")
@@ -1175,6 +1260,10 @@ def azure_tts_v2(text: str, voice_name: str, voice_file: str) -> Union[SubMaker,
             result = speech_synthesizer.speak_text_async(text).get()
             if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
                 logger.success(f"azure v2 speech synthesis succeeded: {voice_file}")
+                if sub_maker.subs and os.path.isfile(voice_file):
+                    tts_cache.put(
+                        key, voice_file, {"offset": sub_maker.offset, "subs": sub_maker.subs}
+                    )
                 return sub_maker
             elif result.reason == speechsdk.ResultReason.Canceled:
                 cancellation_details = result.cancellation_details
@@ -1191,52 +1280,124 @@ def azure_tts_v2(text: str, voice_name: str, voice_file: str) -> Union[SubMaker,
     return None
 
 
+_brackets_table = str.maketrans("[](){}", "      ")
+
+
 def _format_text(text: str) -> str:
-    # text = text.replace("\n", " ")
-    text = text.replace("[", " ")
-    text = text.replace("]", " ")
-    text = text.replace("(", " ")
-    text = text.replace(")", " ")
-    text = text.replace("{", " ")
-    text = text.replace("}", " ")
-    text = text.strip()
-    return text
+    return text.translate(_brackets_table).strip()
+
 
+def _normalize_for_alignment(text: str) -> str:
+    return re.sub(r"[\W_]+", "", text).lower()
 
-def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str):
+
+def align_script_lines(
+    script_lines: List[str], offsets: list, words: List[str], min_ratio: float = 0.6
+):
+    """
+    Fuzzy forced alignment of tts word boundaries to script lines.
+
+    Both sides are reduced to lowercase word characters and matched with difflib,
+    so numbers, punctuation or casing that the voice renders differently only cost
+    the unmatched characters. Each line spans its first matched word up to the next
+    line's first matched word; consecutive lines without any match share the time
+    before the next matched line.
+    Returns [(start, end, line)] in 100ns ticks, or None if less than min_ratio of
+    the script could be matched.
+    """
+    line_chars, line_of_char = [], []
+    for i, line in enumerate(script_lines):
+        chars = _normalize_for_alignment(line)
+        line_chars.append(chars)
+        line_of_char.extend([i] * len(chars))
+    word_chars, word_of_char = [], []
+    for i, word in enumerate(words):
+        chars = _normalize_for_alignment(unescape(word))
+        word_chars.append(chars)
+        word_of_char.extend([i] * len(chars))
+    line_chars, word_chars = "".join(line_chars), "".join(word_chars)
+    if not line_chars or not word_chars:
+        return None
+
+    first_word = [None] * len(script_lines)
+    last_word = [None] * len(script_lines)
+    matched = 0
+    matcher = difflib.SequenceMatcher(None, line_chars, word_chars, autojunk=False)
+    for a, b, size in matcher.get_matching_blocks():
+        for k in range(size):
+            line_index = line_of_char[a + k]
+            if first_word[line_index] is None:
+                first_word[line_index] = word_of_char[b + k]
+            last_word[line_index] = word_of_char[b + k]
+        matched += size
+
+    ratio = matched / len(line_chars)
+    logger.info(f"aligned word boundaries, matched: {ratio:.2%} of the script")
+    if ratio < min_ratio:
+        return None
+
+    # unmatched words between two adjacent lines (e.g. spoken numbers) end the earlier line
+    for i in range(len(script_lines)):
+        if first_word[i] is None:
+            continue
+        if i + 1 == len(script_lines):
+            last_word[i] = len(words) - 1
+        elif first_word[i + 1] is not None:
+            last_word[i] = max(last_word[i], first_word[i + 1] - 1)
+
+    aligned = []
+    previous_end = offsets[0][0]
+    i = 0
+    while i < len(script_lines):
+        if first_word[i] is not None:
+            start = max(offsets[first_word[i]][0], previous_end)
+            end = max(offsets[last_word[i]][1], start)
+            aligned.append((start, end, script_lines[i].strip()))
+            previous_end = end
+            i += 1
+            continue
+
+        j = i
+        while j < len(script_lines) and first_word[j] is None:
+            j += 1
+        gap_end = offsets[first_word[j]][0] if j < len(script_lines) else offsets[-1][1]
+        step = max(gap_end - previous_end, 0) // (j - i)
+        for k in range(i, j):
+            aligned.append((previous_end, previous_end + step, script_lines[k].strip()))
+            previous_end += step
+        i = j
+    return aligned
+
+
+def create_subtitle(
+    sub_maker: submaker.SubMaker, text: str, subtitle_file: str
+) -> Optional[subtitle_cues.Cues]:
     """
     优化字幕文件
     1. 将字幕文件按照标点符号分割成多行
     2. 逐行匹配字幕文件中的文本
     3. 生成新的字幕文件
+    Returns the cues, or None if the word boundaries could not be aligned.
     """
 
     text = _format_text(text)
 
-    def formatter(idx: int, start_time: float, end_time: float, sub_text: str) -> str:
-        """
-        1
-        00:00:00,000 --> 00:00:02,360
-        跑步是一项简单易行的运动
-        """
-        start_t = mktimestamp(start_time).replace(".", ",")
-        end_t = mktimestamp(end_time).replace(".", ",")
-        return f"{idx}\n" f"{start_t} --> {end_t}\n" f"{sub_text}\n"
-
     start_time = -1.0
     sub_items = []
     sub_index = 0
 
-    script_lines = utils.split_string_by_punctuations(text)
+    spans = utils.sentence_spans(text)
 
     def match_line(_sub_line: str, _sub_index: int):
-        if len(script_lines) <= _sub_index:
+        if len(spans) <= _sub_index:
             return ""
 
-        _line = script_lines[_sub_index]
-        if _sub_line == _line:
-            return script_lines[_sub_index].strip()
+        _start, _end = spans[_sub_index]
+        # compare in place, the line is only copied once it matches
+        if len(_sub_line) == _end - _start and text.startswith(_sub_line, _start):
+            return _sub_line.strip()
 
+        _line = text[_start:_end]
         _sub_line_ = re.sub(r"[^\w\s]", "", _sub_line)
         _line_ = re.sub(r"[^\w\s]", "", _line)
         if _sub_line_ == _line_:
@@ -1262,31 +1423,33 @@ def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str)
             sub_text = match_line(sub_line, sub_index)
             if sub_text:
                 sub_index += 1
-                line = formatter(
-                    idx=sub_index,
-                    start_time=start_time,
-                    end_time=end_time,
-                    sub_text=sub_text,
-                )
-                sub_items.append(line)
+                sub_items.append((start_time, end_time, sub_text))
                 start_time = -1.0
                 sub_line = ""
 
-        if len(sub_items) == len(script_lines):
-            with open(subtitle_file, "w", encoding="utf-8") as file:
-                file.write("\n".join(sub_items) + "\n")
-            try:
-                sbs = subtitles.file_to_subtitles(subtitle_file, encoding="utf-8")
-                duration = max([tb for ((ta, tb), txt) in sbs])
-                logger.info(
-                    f"completed, subtitle file created: {subtitle_file}, duration: {duration}"
-                )
-            except Exception as e:
-                logger.error(f"failed, error: {str(e)}")
-                os.remove(subtitle_file)
+        if len(sub_items) != len(spans):
+            logger.warning(
+                f"exact match failed, sub_items len: {len(sub_items)}, script_lines len: {len(spans)}, "
+                f"aligning word boundaries"
+            )
+            script_lines = [text[start:end] for start, end in spans]
+            aligned = align_script_lines(script_lines, sub_maker.offset, sub_maker.subs)
+            if aligned:
+                sub_items = aligned
+
+        if len(sub_items) == len(spans):
+            cues = subtitle_cues.Cues()
+            for start_time, end_time, sub_text in sub_items:
+                # offsets are in 100ns ticks
+                cues.append(round(start_time / 10000), round(end_time / 10000), sub_text)
+            subtitle_cues.save(cues, subtitle_file)
+            logger.info(
+                f"completed, subtitle file created: {subtitle_file}, duration: {cues.duration / 1000}"
+            )
+            return cues
         else:
             logger.warning(
-                f"failed, sub_items len: {len(sub_items)}, script_lines len: {len(script_lines)}"
+                f"failed, sub_items len: {len(sub_items)}, script_lines len: {len(spans)}"
             )
 
     except Exception as e:
@@ -1302,6 +1465,22 @@ def get_audio_duration(sub_maker: submaker.SubMaker):
     return sub_maker.offset[-1][1] / 10000000
 
 
+# typical neural voice speaking speed at rate 1.0
+WORDS_PER_SECOND = 2.5
+CJK_CHARS_PER_SECOND = 4.5
+_cjk_pattern = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+
+
+def estimate_duration(text: str, voice_rate: float = 1.0) -> float:
+    """
+    Rough speech duration of the text, before it is synthesized.
+    """
+    cjk_chars = len(_cjk_pattern.findall(text))
+    words = len(_cjk_pattern.sub(" ", text).split())
+    seconds = cjk_chars / CJK_CHARS_PER_SECOND + words / WORDS_PER_SECOND
+    return seconds / (voice_rate or 1.0)
+
+
 if __name__ == "__main__":
     voice_name = "zh-CN-XiaoxiaoMultilingualNeural-V2-Female"
     voice_name = parse_voice_name(voice_name)
@@ -1,8 +1,9 @@
 import json
 import locale
 import os
+import re
 import threading
-from typing import Any
+from typing import Any, List, Tuple
 from uuid import uuid4
 
 import urllib3
@@ -163,47 +164,44 @@ def text_to_srt(idx: int, msg: str, start_time: float, end_time: float) -> str:
     return srt
 
 
+_punctuations = frozenset("".join(const.PUNCTUATIONS))
+# a newline or punctuation mark ends a sentence, except a dot between digits ("2.5%")
+_sentence_break_pattern = re.compile(
+    "\n|(?!(?<=\\d)\\.(?=\\d))[%s]" % re.escape("".join(sorted(_punctuations)))
+)
+
+
 def str_contains_punctuation(word):
-    for p in const.PUNCTUATIONS:
-        if p in word:
-            return True
-    return False
+    return not _punctuations.isdisjoint(word)
 
 
-def split_string_by_punctuations(s):
+def sentence_spans(s) -> List[Tuple[int, int]]:
+    """
+    (start, end) offsets of the sentences of s, split at newlines and punctuation
+    and trimmed of whitespace; empty sentences are left out.
+    """
+    spans = []
+    start = 0
+    for match in _sentence_break_pattern.finditer(s):
+        spans.append((start, match.start()))
+        start = match.end()
+    spans.append((start, len(s)))
+
     result = []
-    txt = ""
-
-    previous_char = ""
-    next_char = ""
-    for i in range(len(s)):
-        char = s[i]
-        if char == "\n":
-            result.append(txt.strip())
-            txt = ""
-            continue
-
-        if i > 0:
-            previous_char = s[i - 1]
-        if i < len(s) - 1:
-            next_char = s[i + 1]
-
-        if char == "." and previous_char.isdigit() and next_char.isdigit():
-            # # In the case of "withdraw 10,000, charged at 2.5% fee", the dot in "2.5" should not be treated as a line break marker
-            txt += char
-            continue
-
-        if char not in const.PUNCTUATIONS:
-            txt += char
-        else:
-            result.append(txt.strip())
-            txt = ""
-    result.append(txt.strip())
-    # filter empty string
-    result = list(filter(None, result))
+    for start, end in spans:
+        while start < end and s[start].isspace():
+            start += 1
+        while end > start and s[end - 1].isspace():
+            end -= 1
+        if start < end:
+            result.append((start, end))
     return result
 
 
+def split_string_by_punctuations(s):
+    return [s[start:end] for start, end in sentence_spans(s)]
+
+
 def md5(text):
     import hashlib
 